@@ -3,8 +3,10 @@
    This module contains the overaching GUI and application for the VPN assignment.
 
    The VPNApp class is defined here, as well as the neccesary callbacks to tie into
-   underlying modules such as Diffie-Hellman key exchange and authentication, AES encryption,
-   MAC calculation and check, and sending/receiving of data.
+   underlying modules such as Diffie-Hellman key exchange and authentication, session resumption,
+   key derivation and rekeying, encrypt-then-MAC protection of messages (AES-CTR and AES-CMAC),
+   and sending/receiving of data. In server mode it serves any number of clients at once,
+   each with its own handshake and session keys.
 
    It also contains a WidgetLogger, used to direct log messages to the text window.
    
@@ -13,23 +15,37 @@
 from tkinter import *
 
 import tkinter.scrolledtext as tkst
+import concurrent.futures
 import logging
 import struct
 import sys
 import hashlib
 
 import dh_auth
-import aes
-import mac
 import connector
+import handshake
+import kdf
+import resumption
 from multiprocessing.pool import ThreadPool
 
 # States of the connection
 DISCONNECTED, CONNECTING, CONNECTED = 0, 1, 2
-MAC_KEY = b''
 
 pool = ThreadPool(processes=1)
 
+# Seconds the server waits for each handshake message from a client
+HANDSHAKE_TIMEOUT = 30
+
+# Server handshakes run at once. Their threads mostly wait, on the client or on the
+# handshake engine's worker processes, which do the modular exponentiation.
+SERVER_HANDSHAKE_THREADS = 32
+server_handshakes = concurrent.futures.ThreadPoolExecutor(SERVER_HANDSHAKE_THREADS)
+
+# Session resumption state: tickets issued while acting as the server, and tickets
+# received from servers while acting as the client
+ticket_issuer = resumption.TicketIssuer()
+client_tickets = resumption.ClientTickets()
+
 class WidgetLogger(logging.Handler):
     """TkInter text widget to setup logging"""
     def __init__(self, widget):
@@ -59,6 +75,10 @@ class VPNApp(Frame):
         self.is_client = True
         self.connector = None
         self.connect_result = None
+        self.session_keys = None
+        # In server mode: the SessionServer, and its sessions that have authenticated
+        self.server = None
+        self.sessions = []
         self.state = DISCONNECTED
 
         # Use the GridManager
@@ -166,12 +186,21 @@ class VPNApp(Frame):
         """
         Begin a connection with the specified host/port if needed.
         """
-        if self.state == DISCONNECTED:
+        if self.state == DISCONNECTED and not self.is_client:
+            port = self.port_entry.get()
+            try:
+                self.server = start_server(port, self.shared_value_entry.get(), self.session_authenticated)
+            except OSError as e:
+                self.logger.info('Could not start the server: ' + str(e))
+                return
+            self.logger.info('Server listening on {}:{}'.format(connector.get_ip(), self.server.port))
+            self.state = CONNECTED
+        elif self.state == DISCONNECTED:
             self.logger.info('Connecting')
             self.state = CONNECTING
             arg_tuple = (self.ip_addr_entry.get(), self.port_entry.get(), 
-                self.shared_value_entry.get(), not self.is_client)
-            self.connect_result = pool.apply_async(connect, arg_tuple)
+                self.shared_value_entry.get())
+            self.connect_result = pool.apply_async(connect, arg_tuple, callback=self.connect_done)
         else:
             self.logger.info('Already connected.')
 
@@ -183,14 +212,22 @@ class VPNApp(Frame):
             self.logger.info('No connection established')
             return
         to_send = self.send_entry.get()
-        if to_send and self.connector:
-            self.logger.info('Encrypting message')
-            encrypted = aes.aes_encrypt(to_send, self.session_key)
-            encoded = bytes(encrypted)
-            self.logger.info('Calculating MAC')
-            mac_val = mac.get_mac(to_send, MAC_KEY)
+        if to_send and self.server:
+            if not self.sessions:
+                self.logger.info('No client connected')
+            payload = to_send.encode('utf-8')
+            for session in self.sessions:
+                self.logger.info('Sending encrypted message to ' + str(session.addr[0]))
+                try:
+                    session.send(session.keys.seal(payload))
+                except connector.ConnectionDeadException:
+                    pass
+        elif to_send and self.connector:
+            self.logger.info('Encrypting and authenticating message')
+            payload = to_send.encode('utf-8')
+            frame = self.session_keys.seal(payload)
             self.logger.info('Sending encrypted message')
-            self.connector.send(encoded + bytes(mac_val[0]) + bytes(mac_val[1]))
+            self.connector.send(frame)
 
     def continue_callback(self):
         pass
@@ -199,8 +236,18 @@ class VPNApp(Frame):
         """
         Disconnect and clean up
         """
-        self.connector.close()
+        if self.server:
+            self.server.close()
+            self.server = None
+            for session in self.sessions:
+                session.keys.close()
+            self.sessions = []
+        elif self.connector:
+            self.connector.close()
         self.state = DISCONNECTED
+        # The session keys are retired, drop their expanded round keys
+        if self.session_keys:
+            self.session_keys.close()
         self.logger.info('Stopping connection')
         pass
 
@@ -224,137 +271,279 @@ class VPNApp(Frame):
         button.pack()
         pass
 
-    def receive(self):
+    def connect_done(self, result):
         """
-        Receive and decrypt data and populate the received entry field.
+        Called from the pool thread when connect finishes; hands the result to the GUI thread.
+        """
+        self.after(0, self.connected, result)
+
+    def connected(self, result):
         """
-        if self.connector is None:
+        Take over the session keys and connector from a finished connect, and have
+        received frames delivered as soon as they arrive.
+        """
+        if self.state != CONNECTING:
+            return
+        session_keys, self.connector = result
+        if session_keys == 0:
+            # Authentication failed; there are no keys to seal or open frames with
+            self.logger.info('Connection failed: could not authenticate the peer')
+            self.connector.close()
+            self.state = DISCONNECTED
             return
-        encrypted = self.connector.receive()
+        self.session_keys = session_keys
+        self.state = CONNECTED
+        self.connector.subscribe(self.frame_received)
+
+    def session_authenticated(self, session):
+        """
+        Called from a server handshake thread once a client has authenticated; hands the
+        session to the GUI thread.
+        """
+        self.after(0, self.add_session, session)
+
+    def add_session(self, session):
+        """
+        Start exchanging messages with an authenticated client of the server.
+        """
+        if self.server is None or session.server is not self.server:
+            # The server was stopped while the client was authenticating
+            session.close()
+            return
+        self.logger.info('Client authenticated: ' + str(session.addr[0]))
+        self.sessions.append(session)
+        session.subscribe(lambda encrypted: self.after(0, self.receive, encrypted, session.keys))
+
+    def prune_sessions(self):
+        """
+        Forget the server sessions that have ended, dropping their keys.
+        """
+        for session in [s for s in self.sessions if not s.is_alive()]:
+            self.logger.info('Client disconnected: ' + str(session.addr[0]))
+            session.keys.close()
+            self.sessions.remove(session)
+
+    def frame_received(self, encrypted):
+        """
+        Called from the connector's receiver thread; hands the frame to the GUI thread.
+        """
+        self.after(0, self.receive, encrypted)
+
+    def receive(self, encrypted, session_keys=None):
+        """
+        Decrypt received data and populate the received entry field. session_keys are
+        those of the server session the frame came from; the client uses its own.
+        """
         if encrypted:
             self.logger.info('Encrypted data, received: ' + connector.bytestring_as_hex_string(encrypted))
-            msg_bytes = aes.aes_decrypt(encrypted[:-32], self.session_key)
-            message = bytes(msg_bytes)
-            self.logger.info('Decrypted message: ' + str(message))
-            mac_val = encrypted[-16:]
-            mac_iv = encrypted[-32:-16]
-            verified = mac.check_mac(message, mac_val, MAC_KEY, mac_iv)
-            if verified:
+            # The tag covers the ciphertext and is checked first, so forged frames are
+            # dropped without being decrypted
+            message = (session_keys or self.session_keys).open(encrypted)
+            if message is not None:
                 self.logger.info('MAC check SUCCESS')
+                self.logger.info('Decrypted message: ' + str(message))
                 self.received_entry.delete(0, END)
                 self.received_entry.insert(0, message)
             else:
-                self.logger.info.info("MAC check FAILURE")
+                self.logger.info("MAC check FAILURE")
 
     def disconnected(self):
+        if self.server:
+            return not self.server.is_alive()
         return not self.connector.is_alive()
 
-def connect(host, port, shared_value, is_server):
+def long_term_key_from(shared_value):
+    """
+    Returns the 16 byte long-term key, a hash of the shared secret value. It encrypts
+    the Diffie-Hellman exchange, which ensures Perfect Forward Secrecy.
+    """
+    md5_key = hashlib.md5()
+    md5_key.update(shared_value.encode('utf-8'))
+    return md5_key.digest()
+
+def connect(host, port, shared_value):
     """
-    Connect to the host:port with the Diffie-Hellman exchange, making sure to
+    Connect to the server at host:port with the Diffie-Hellman exchange, making sure to
     authenticate the connection.
     """
-    global MAC_KEY
     ctr = None
     if port:
-        ctr = connector.Connector(is_server, host, port)
+        ctr = connector.Connector(False, host, port)
     else:
-        ctr = connector.Connector(is_server, host)
+        ctr = connector.Connector(False, host)
 
-    # Generate a 16 byte key, from a hash of the shared secret value.
-    # Then use that value, to encrypt a Diffie-Hellman exchange to 
-    # ensure Perfect Forward Secrecy.
-    md5_key = hashlib.md5()
-    shared_val = shared_value.encode('utf-8')
-    md5_key.update(shared_val)
-    long_term_key = md5_key.digest()
+    long_term_key = long_term_key_from(shared_value)
 
-    md5_key = hashlib.md5()
-    md5_key.update(long_term_key)
-    MAC_KEY = md5_key.digest()
-    
     ctr.connect()
     
     session_key = []
     
-    if not is_server:
-        #Client Authenticated DH exchange
-        # Send initial DH trigger message
-        logging.getLogger().info('Sending initial authentication message')
-        client_dh_init_msg = dh_auth.gen_auth_msg()
-        ctr.send(bytes(client_dh_init_msg))
-        
-        # Receive server authentication response
-        logging.getLogger().info('Waiting for server authentication response')
-        rcv_server_public_transport = ctr.receive_wait()
-        rcv_server_nonce = rcv_server_public_transport[:16]
-        rcv_server_dh_data_encrypted = rcv_server_public_transport[16:]  
-        
-        # Send back client authentication response
-        logging.getLogger().info('Sending client authentication response')
-        client_auth_msg = dh_auth.gen_auth_msg(rcv_server_nonce)
-        client_dh_data_tup = dh_auth.gen_public_transport(long_term_key, client_auth_msg)
-        client_public_transport = client_dh_data_tup[dh_auth.PUB_TRANSPORT_IDX]
-        ctr.send(bytes(client_public_transport))
-        
-        # Authenticate received data from server
-        logging.getLogger().info('Authenticating data received from server')
-        expect_rcv_server_id = [int(byte) for byte in host.split('.')]
-        expect_rcv_server_auth_msg = expect_rcv_server_id + client_dh_init_msg[4:]
-        
-        logging.getLogger().info('Generating session key')
-        session_key = dh_auth.gen_session_key(rcv_server_dh_data_encrypted, client_dh_data_tup[dh_auth.LOC_EXPONENT_IDX], long_term_key, expect_rcv_server_auth_msg)
-        
-    else:
-        #Server Authenticated DH exchange
-        # Receive initial DH trigger message
-        logging.getLogger().info('Waiting for initial authentication message')
-        rcv_client_dh_data = ctr.receive_wait()
-        rcv_client_id = rcv_client_dh_data[:4]
-        rcv_client_nonce = rcv_client_dh_data[4:]
-        
-        # send response
-        logging.getLogger().info('Sending server authentication response')
-        server_nonce = dh_auth.gen_nonce()
-        server_auth_msg = dh_auth.gen_auth_msg(rcv_client_nonce) 
-        server_dh_data_tup = dh_auth.gen_public_transport(long_term_key, server_auth_msg)
-        server_public_transport = server_nonce + server_dh_data_tup[dh_auth.PUB_TRANSPORT_IDX]
-        ctr.send(bytes(server_public_transport))
-        
-        # Receive client authentication response - client_public_transport is the same as rcv_client_dh_data_encrypted
-        logging.getLogger().info('Waiting for client authentication response')
-        rcv_client_public_transport = ctr.receive_wait()
-        
-        # Authenticate received data from client
-        logging.getLogger().info('Authenticating client response')
-        expect_rcv_client_auth_msg = list(rcv_client_id) + list(server_nonce)
-        session_key = dh_auth.gen_session_key(rcv_client_public_transport, server_dh_data_tup[dh_auth.LOC_EXPONENT_IDX], long_term_key, expect_rcv_client_auth_msg)
+    # Try to resume the previous session with this server before a full exchange
+    peer = (host, ctr.port)
+    resume = client_tickets.resume_request(peer)
+    if resume:
+        logging.getLogger().info('Sending session resumption request')
+        ctr.send(resume[0])
+        session_key = client_tickets.complete(resume[1], ctr.receive_wait(), long_term_key)
+        if session_key is not None:
+            return (_derive_keys(session_key, long_term_key, False), ctr)
+        logging.getLogger().info('Session resumption refused, falling back to full authentication')
+
+    #Client Authenticated DH exchange
+    # Send initial DH trigger message
+    logging.getLogger().info('Sending initial authentication message')
+    client_dh_init_msg = dh_auth.gen_auth_msg()
+    ctr.send(bytes(client_dh_init_msg))
+    
+    # Receive server authentication response
+    logging.getLogger().info('Waiting for server authentication response')
+    rcv_server_public_transport = ctr.receive_wait()
+    rcv_server_nonce = rcv_server_public_transport[:16]
+    rcv_server_dh_data_encrypted = rcv_server_public_transport[16:]  
+    
+    # Send back client authentication response
+    logging.getLogger().info('Sending client authentication response')
+    client_auth_msg = dh_auth.gen_auth_msg(rcv_server_nonce)
+    client_dh_data_tup = dh_auth.gen_public_transport(long_term_key, client_auth_msg)
+    client_public_transport = client_dh_data_tup[dh_auth.PUB_TRANSPORT_IDX]
+    ctr.send(bytes(client_public_transport))
+    
+    # Authenticate received data from server
+    logging.getLogger().info('Authenticating data received from server')
+    expect_rcv_server_id = [int(byte) for byte in host.split('.')]
+    expect_rcv_server_auth_msg = expect_rcv_server_id + client_dh_init_msg[4:]
+    
+    logging.getLogger().info('Generating session key')
+    session_key_future = handshake.get_handshake_engine().session_key(rcv_server_dh_data_encrypted, client_dh_data_tup[dh_auth.LOC_EXPONENT_IDX], long_term_key, expect_rcv_server_auth_msg)
+
+    # Keep the resumption ticket the server issues for this session
+    logging.getLogger().info('Waiting for session resumption ticket')
+    rcv_ticket = ctr.receive_wait()
+    session_key = session_key_future.result()
+    if session_key != 0:
+        client_tickets.store(peer, rcv_ticket, session_key, long_term_key)
 
-    if session_key == 0:
-        logging.getLogger().info('Failed to authenticate: session key invalid')
-    else:
-        logging.getLogger().info('Authenticated with session key: ' + connector.bytestring_as_hex_string(session_key))
     # Enforce Perfect Forward Security by forgetting local exponent 
     client_dh_data_tup = (0,0)
+
+    return (_derive_keys(session_key, long_term_key, False), ctr)
+
+def start_server(port, shared_value, on_authenticated):
+    """
+    Starts a connector.SessionServer on port that authenticates every client that
+    connects, each in its own handshake thread, with the shared secret value.
+    on_authenticated(session) is called from that thread for every session that
+    authenticates, with its kdf.SessionKeys in session.keys.
+
+    Returns the started SessionServer.
+    """
+    long_term_key = long_term_key_from(shared_value)
+
+    def on_session(session):
+        # Runs on the server thread, which must not block
+        server_handshakes.submit(_serve_session, session, long_term_key, on_authenticated)
+
+    server = connector.SessionServer(connector.HOST, port or connector.PORT, on_session)
+    server.start()
+    return server
+
+def _serve_session(session, long_term_key, on_authenticated):
+    """
+    Handshake thread: authenticates the client of session, then hands the session on,
+    or closes it if authentication failed.
+    """
+    try:
+        session_keys = accept_session(session, long_term_key)
+    except (Exception, connector.ConnectionDeadException):
+        logging.getLogger().exception('Handshake with ' + str(session.addr[0]) + ' failed')
+        session_keys = 0
+    if session_keys == 0:
+        session.close()
+        return
+    session.keys = session_keys
+    on_authenticated(session)
+
+def accept_session(session, long_term_key):
+    """
+    Runs the server side of the authenticated Diffie-Hellman exchange, or of a session
+    resumption, with the client of a connector.ServerSession. The shared secret is
+    computed by the handshake engine, so handshakes with many clients run in parallel.
+
+    Returns the kdf.SessionKeys of the session, or 0 if the client did not authenticate
+    or stopped answering.
+    """
+    # Receive initial DH trigger message, or a session resumption request
+    logging.getLogger().info('Waiting for initial authentication message')
+    rcv_client_dh_data = session.receive(timeout=HANDSHAKE_TIMEOUT)
+    if rcv_client_dh_data is not None and resumption.is_resume_request(rcv_client_dh_data):
+        logging.getLogger().info('Received session resumption request')
+        session_key, response = ticket_issuer.resume(rcv_client_dh_data, long_term_key)
+        session.send(response)
+        if session_key is not None:
+            return _derive_keys(session_key, long_term_key, True)
+        logging.getLogger().info('Session resumption refused, waiting for initial authentication message')
+        rcv_client_dh_data = session.receive(timeout=HANDSHAKE_TIMEOUT)
+    if rcv_client_dh_data is None:
+        logging.getLogger().info('Failed to authenticate: no initial authentication message')
+        return 0
+
+    #Server Authenticated DH exchange
+    rcv_client_id = rcv_client_dh_data[:4]
+    rcv_client_nonce = rcv_client_dh_data[4:]
+    
+    # send response
+    logging.getLogger().info('Sending server authentication response')
+    server_nonce = dh_auth.gen_nonce()
+    server_auth_msg = dh_auth.gen_auth_msg(rcv_client_nonce) 
+    server_dh_data_tup = dh_auth.gen_public_transport(long_term_key, server_auth_msg)
+    server_public_transport = server_nonce + server_dh_data_tup[dh_auth.PUB_TRANSPORT_IDX]
+    session.send(bytes(server_public_transport))
+    
+    # Receive client authentication response - client_public_transport is the same as rcv_client_dh_data_encrypted
+    logging.getLogger().info('Waiting for client authentication response')
+    rcv_client_public_transport = session.receive(timeout=HANDSHAKE_TIMEOUT)
+    if rcv_client_public_transport is None:
+        logging.getLogger().info('Failed to authenticate: no client authentication response')
+        return 0
+    
+    # Authenticate received data from client
+    logging.getLogger().info('Authenticating client response')
+    expect_rcv_client_auth_msg = list(rcv_client_id) + list(server_nonce)
+    session_key = handshake.get_handshake_engine().session_key(rcv_client_public_transport, server_dh_data_tup[dh_auth.LOC_EXPONENT_IDX], long_term_key, expect_rcv_client_auth_msg).result()
+
+    # Enforce Perfect Forward Security by forgetting local exponent 
     server_dh_data_tup = (0,0)
 
-    return (session_key, ctr)
+    # Issue a ticket so the client can resume without a full exchange
+    logging.getLogger().info('Sending session resumption ticket')
+    session.send(ticket_issuer.issue(session_key, long_term_key))
+
+    return _derive_keys(session_key, long_term_key, True)
+
+def _derive_keys(session_key, long_term_key, is_server):
+    """
+    Log the outcome of the key exchange and return the session keys derived from the
+    shared secret, or 0 if authentication failed.
+    """
+    if session_key == 0:
+        logging.getLogger().info('Failed to authenticate: session key invalid')
+        return 0
+    logging.getLogger().info('Authenticated, deriving session keys')
+    return kdf.SessionKeys(session_key, long_term_key, is_server)
 
 def task_loop(app, root):
     """
     Main application loop that runs every 500ms.
     """
     if app.state == CONNECTING:
+        # connect_done normally gets here first; this also surfaces errors from connect
         if app.connect_result.ready():
-            res = app.connect_result.get()
-            app.session_key = res[0]
-            app.connector = res[1] 
-            app.state = CONNECTED
+            app.connected(app.connect_result.get())
     elif app.state == CONNECTED:
         if app.disconnected():
             app.state = DISCONNECTED
-        else:
-            app.receive()
+        elif app.server:
+            app.prune_sessions()
     root.after(500, task_loop, app, root)
 
 def main():
@@ -362,6 +551,11 @@ def main():
     root = Tk()
     root.geometry("700x700+100+50")
 
+    # Start precomputing Diffie-Hellman key pairs while the connection details are entered,
+    # and the worker processes that compute the shared secrets
+    dh_auth.get_key_pool()
+    handshake.get_handshake_engine()
+
     # Create a calibration application using that root
     app = VPNApp(root)
 
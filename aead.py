@@ -0,0 +1,223 @@
+"""
+Authenticated encryption module
+
+Implements AES-CCM (NIST SP 800-38C, RFC 3610): counter mode encryption combined with
+a CBC-MAC over the nonce, associated data and message, built on the block cipher
+engines in aes. ccm_seal and ccm_open do the whole job for a message in a single call.
+
+Also implements encrypt-then-MAC with separate keys: counter mode encryption followed by
+an AES-CMAC over the nonce, associated data and ciphertext. Since the tag covers the
+ciphertext, etm_open rejects a forged or corrupt frame before decrypting anything.
+
+Functions:
+
+ccm_seal -- Encrypts and authenticates a message with AES-CCM.
+ccm_open -- Checks and decrypts an AES-CCM message.
+etm_seal -- Encrypts then authenticates a message.
+etm_open -- Checks then decrypts an encrypt-then-MAC message.
+gen_nonce -- Generates a random nonce.
+self_test -- Runs the SP 800-38C known-answer tests and an encrypt-then-MAC round trip.
+"""
+
+import hmac
+import secrets
+
+import aes
+import mac
+
+BLOCK_SIZE_BYTES = 16
+
+# Default nonce and tag lengths. A 12 byte nonce leaves a 3 byte length field, which
+# allows messages up to 16 MB.
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# NIST SP 800-38C appendix C examples 1 to 3 as (tag size, nonce, associated data,
+# plaintext, ciphertext and tag) in hex, all under KNOWN_ANSWER_CCM_KEY
+KNOWN_ANSWER_CCM_KEY = '404142434445464748494a4b4c4d4e4f'
+KNOWN_ANSWERS_CCM = [(4, '10111213141516', '0001020304050607', '20212223', '7162015b4dac255d'),
+                     (6, '1011121314151617', '000102030405060708090a0b0c0d0e0f',
+                      '202122232425262728292a2b2c2d2e2f', 'd2a1f0e051ea5f62081a7792073d593d1fc64fbfaccd'),
+                     (8, '101112131415161718191a1b', '000102030405060708090a0b0c0d0e0f10111213',
+                      '202122232425262728292a2b2c2d2e2f3031323334353637',
+                      'e3b201a9f5b71a7a9b1ceaeccd97e70b6176aad9a4428aa5484392fbc1b09951')]
+
+def gen_nonce(size=NONCE_SIZE):
+    """
+    Returns a new random nonce of size bytes from the OS CSPRNG. A nonce must never be
+    reused with the same key.
+    """
+    return secrets.token_bytes(size)
+
+def _check_params(nonce, length, tag_size):
+    if not 7 <= len(nonce) <= 13:
+        raise ValueError('The nonce must be 7 to 13 bytes')
+    if tag_size not in (4, 6, 8, 10, 12, 14, 16):
+        raise ValueError('The tag must be an even number of bytes from 4 to 16')
+    if length >= 1 << (8 * (15 - len(nonce))):
+        raise ValueError('The message is too long for a {} byte nonce'.format(len(nonce)))
+
+def _encode_aad(aad):
+    """Returns the length-prefixed, zero padded encoding of the associated data."""
+    length = len(aad)
+    if length == 0:
+        return b''
+    if length < 0xff00:
+        prefix = length.to_bytes(2, 'big')
+    elif length < 1 << 32:
+        prefix = b'\xff\xfe' + length.to_bytes(4, 'big')
+    else:
+        prefix = b'\xff\xff' + length.to_bytes(8, 'big')
+    encoded = prefix + bytes(aad)
+    return encoded + bytes(-len(encoded) % BLOCK_SIZE_BYTES)
+
+def _cbc_mac(schedule, nonce, aad, plaintext, tag_size):
+    """Returns the CCM CBC-MAC (before masking) of the formatted nonce, aad and plaintext."""
+    q = 15 - len(nonce)
+    flags = (0x40 if aad else 0) | ((tag_size - 2) // 2) << 3 | (q - 1)
+    b0 = bytes([flags]) + bytes(nonce) + len(plaintext).to_bytes(q, 'big')
+    blocks = b0 + _encode_aad(aad) + bytes(plaintext) + bytes(-len(plaintext) % BLOCK_SIZE_BYTES)
+    return aes.get_engine().cbc_encrypt(schedule, bytes(BLOCK_SIZE_BYTES), blocks)[-BLOCK_SIZE_BYTES:]
+
+def _keystream(key, nonce, length):
+    """Returns the keystream for a message of length bytes; its first block masks the tag."""
+    q = 15 - len(nonce)
+    ctr0 = bytes([q - 1]) + bytes(nonce) + bytes(q)
+    return aes.aes_ctr_keystream(key, ctr0, 1 + (length + BLOCK_SIZE_BYTES - 1) // BLOCK_SIZE_BYTES)
+
+def ccm_seal(key, nonce, plaintext, aad=b'', tag_size=TAG_SIZE):
+    """
+    Encrypts and authenticates plaintext with AES-CCM.
+
+    Arguments:
+    key -- 16 byte key (bytes, a list of bytes or a string).
+    nonce -- 7 to 13 byte nonce, unique for every message sealed under key.
+    plaintext -- Message as a bytes-like object.
+    aad -- Associated data that is authenticated but not encrypted.
+    tag_size -- Length of the authentication tag in bytes.
+
+    Returns the ciphertext followed by the tag, as bytes.
+    """
+    plaintext = memoryview(plaintext).cast('B')
+    length = len(plaintext)
+    _check_params(nonce, length, tag_size)
+    schedule = aes.get_key_schedule(key)
+    tag = _cbc_mac(schedule, nonce, aad, plaintext, tag_size)
+    keystream = _keystream(key, nonce, length)
+    sealed = bytearray(length + tag_size)
+    aes.xor_into(plaintext, memoryview(keystream)[BLOCK_SIZE_BYTES:], sealed)
+    aes.xor_into(tag[:tag_size], keystream, sealed, length)
+    return bytes(sealed)
+
+def ccm_open(key, nonce, sealed, aad=b'', tag_size=TAG_SIZE):
+    """
+    Decrypts and checks a message sealed with ccm_seal.
+
+    Arguments:
+    key -- 16 byte key (bytes, a list of bytes or a string).
+    nonce -- The nonce the message was sealed with.
+    sealed -- Ciphertext followed by the tag, as a bytes-like object.
+    aad -- The associated data the message was sealed with.
+    tag_size -- Length of the authentication tag in bytes.
+
+    Returns the plaintext as bytes, or None if the message is not authentic.
+    """
+    sealed = memoryview(sealed).cast('B')
+    length = len(sealed) - tag_size
+    if length < 0:
+        return None
+    _check_params(nonce, length, tag_size)
+    schedule = aes.get_key_schedule(key)
+    keystream = _keystream(key, nonce, length)
+    plaintext = bytearray(length)
+    aes.xor_into(sealed[:length], memoryview(keystream)[BLOCK_SIZE_BYTES:], plaintext)
+    expected = bytearray(tag_size)
+    aes.xor_into(_cbc_mac(schedule, nonce, aad, plaintext, tag_size)[:tag_size], keystream, expected)
+    if not hmac.compare_digest(bytes(expected), bytes(sealed[length:])):
+        return None
+    return bytes(plaintext)
+
+def _etm_tag(mac_key, nonce, aad, ciphertext):
+    """Returns the CMAC of the nonce, the length of aad, aad and the ciphertext."""
+    header = bytes(nonce) + len(aad).to_bytes(8, 'big') + bytes(aad)
+    return mac.cmac(mac_key, header + bytes(ciphertext))
+
+def _etm_keystream(enc_key, nonce, length):
+    """Returns the counter mode keystream for length bytes, counting from nonce || 0."""
+    counter = bytes(nonce) + bytes(BLOCK_SIZE_BYTES - len(nonce))
+    return aes.aes_ctr_keystream(enc_key, counter, (length + BLOCK_SIZE_BYTES - 1) // BLOCK_SIZE_BYTES)
+
+def etm_seal(enc_key, mac_key, nonce, plaintext, aad=b''):
+    """
+    Encrypts plaintext with AES-CTR under enc_key, then authenticates the ciphertext
+    with AES-CMAC under mac_key.
+
+    Arguments:
+    enc_key -- 16 byte encryption key (bytes, a list of bytes or a string).
+    mac_key -- 16 byte MAC key, independent of enc_key.
+    nonce -- Nonce of NONCE_SIZE bytes, unique for every message sealed under enc_key.
+    plaintext -- Message as a bytes-like object.
+    aad -- Associated data that is authenticated but not encrypted.
+
+    Returns the ciphertext followed by the TAG_SIZE byte tag, as bytes.
+    """
+    if len(nonce) != NONCE_SIZE:
+        raise ValueError('The nonce must be {} bytes'.format(NONCE_SIZE))
+    plaintext = memoryview(plaintext).cast('B')
+    length = len(plaintext)
+    sealed = bytearray(length + TAG_SIZE)
+    aes.xor_into(plaintext, _etm_keystream(enc_key, nonce, length), sealed)
+    sealed[length:] = _etm_tag(mac_key, nonce, aad, memoryview(sealed)[:length])
+    return bytes(sealed)
+
+def etm_open(enc_key, mac_key, nonce, sealed, aad=b''):
+    """
+    Checks and decrypts a message sealed with etm_seal. The tag is compared in constant
+    time before any decryption is done, so invalid frames only cost the MAC.
+
+    Arguments:
+    enc_key -- 16 byte encryption key (bytes, a list of bytes or a string).
+    mac_key -- 16 byte MAC key.
+    nonce -- The nonce the message was sealed with.
+    sealed -- Ciphertext followed by the tag, as a bytes-like object.
+    aad -- The associated data the message was sealed with.
+
+    Returns the plaintext as bytes, or None if the message is not authentic.
+    """
+    sealed = memoryview(sealed).cast('B')
+    length = len(sealed) - TAG_SIZE
+    if length < 0 or len(nonce) != NONCE_SIZE:
+        return None
+    ciphertext = sealed[:length]
+    if not hmac.compare_digest(_etm_tag(mac_key, nonce, aad, ciphertext), bytes(sealed[length:])):
+        return None
+    plaintext = bytearray(length)
+    aes.xor_into(ciphertext, _etm_keystream(enc_key, nonce, length), plaintext)
+    return bytes(plaintext)
+
+def self_test():
+    """
+    Runs the SP 800-38C known-answer tests against ccm_seal and ccm_open, and checks that an
+    encrypt-then-MAC message round trips and is rejected once altered. (etm_seal is
+    specific to this module and has no published vectors; its CMAC is checked by
+    mac.self_test.)
+
+    Returns True if every check passed.
+    """
+    key = bytes.fromhex(KNOWN_ANSWER_CCM_KEY)
+    for tag_size, nonce, aad, plaintext, sealed in KNOWN_ANSWERS_CCM:
+        nonce, aad, plaintext, sealed = [bytes.fromhex(x) for x in (nonce, aad, plaintext, sealed)]
+        if ccm_seal(key, nonce, plaintext, aad, tag_size) != sealed:
+            return False
+        if ccm_open(key, nonce, sealed, aad, tag_size) != plaintext:
+            return False
+    enc_key, mac_key, nonce = bytes(range(16)), bytes(range(16, 32)), bytes(NONCE_SIZE)
+    plaintext = bytes(range(256)) * 3
+    sealed = bytearray(etm_seal(enc_key, mac_key, nonce, plaintext, b'aad'))
+    if etm_open(enc_key, mac_key, nonce, sealed, b'aad') != plaintext:
+        return False
+    sealed[0] ^= 1
+    return etm_open(enc_key, mac_key, nonce, sealed, b'aad') is None
+
+if __name__ == '__main__':
+    print('CCM known answers: ' + ('ok' if self_test() else 'FAILED'))
@@ -1,13 +1,65 @@
-"""This module contains an implementation of 128-bit key AES in CBC mode.
+"""This module contains an implementation of 128-bit key AES in CBC and CTR modes.
+
+The modes run on top of a registry of block cipher engines (the reference 4x4 implementation,
+the table-driven engine, the optional NumPy batch engine and the optional cryptography package).
+The fastest engine passing its known-answer tests is chosen on first use and remembered in
+ENGINE_CACHE_FILE; set VPN_AES_ENGINE or call set_engine to choose one explicitly.
 
 Functions:
 
 aes_encrypt -- Encrypts supplied data using AES with a given key.
 aes_decrypt -- Decrypts supplied ciphertext using AES with a given key.
+aes_singleblock -- Encrypts one block with the table-driven engine.
+aes_singleblock_inverse -- Decrypts one block with the table-driven engine.
+numpy_encrypt_blocks -- Encrypts many blocks at once with the optional NumPy engine.
+numpy_decrypt_blocks -- Decrypts many blocks at once with the optional NumPy engine.
+aes_encrypt_into -- Encrypts any bytes-like object into a caller-supplied bytearray.
+aes_decrypt_into -- Decrypts any bytes-like object into a caller-supplied bytearray,
+                    optionally splitting large ciphertexts across a process pool.
+Encryptor -- Incremental AES-CBC encryption with update()/finalize().
+Decryptor -- Incremental AES-CBC decryption with update()/finalize().
+aes_ctr_encrypt_into -- Encrypts with AES in counter mode into a caller-supplied bytearray.
+aes_ctr_decrypt_into -- Decrypts AES counter mode data into a caller-supplied bytearray.
+aes_ctr_keystream -- Generates counter mode keystream ahead of time.
+set_engine -- Selects the block cipher engine by name.
+get_engine -- Returns the selected block cipher engine.
+get_key_schedule -- Returns the cached expanded round keys for a key.
+invalidate_key_schedule -- Drops cached round keys, e.g. after a rekey.
 """
 
-import random
-import math
+import threading
+import collections
+import struct
+import os
+import multiprocessing
+import sys
+import time
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+# A 16 byte block as four big-endian column words
+block_struct = struct.Struct('>4I')
+
+# Number of expanded keys kept by the key schedule cache before the least recently
+# used one is evicted.
+KEY_SCHEDULE_CACHE_SIZE = 32
+
+# Ciphertexts with fewer blocks than this are always decrypted in-process; below it
+# shipping the data to worker processes costs more than it saves.
+PARALLEL_MIN_BLOCKS = 2048
+
+# Batches with fewer blocks than this use the pure Python engine even when NumPy is
+# available; below it the array setup costs more than vectorizing saves.
+NUMPY_MIN_BLOCKS = 32
 
 bytesub_table = [['0x63', '0x7C', '0x77', '0x7B', '0xF2', '0x6B', '0x6F', '0xC5', '0x30', '0x01', '0x67', '0x2B', '0xFE', '0xD7', '0xAB', '0x76'],
                  ['0xCA', '0x82', '0xC9', '0x7D', '0xFA', '0x59', '0x47', '0xF0', '0xAD', '0xD4', '0xA2', '0xAF', '0x9C', '0xA4', '0x72', '0xC0'],
@@ -162,6 +214,49 @@ rcon = [0x8d, 0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1b, 0x36, 0x6c,
         0xc6, 0x97, 0x35, 0x6a, 0xd4, 0xb3, 0x7d, 0xfa, 0xef, 0xc5, 0x91, 0x39, 0x72, 0xe4, 0xd3, 0xbd,
         0x61, 0xc2, 0x9f, 0x25, 0x4a, 0x94, 0x33, 0x66, 0xcc, 0x83, 0x1d, 0x3a, 0x74, 0xe8, 0xcb, 0x8d]
 
+# Integer versions of the tables above, used by the table-driven engine so that the
+# hot path never has to format or parse hex strings.
+sbox = [int(bytesub_table[i >> 4][i & 0xf], 16) for i in range(256)]
+inv_sbox = [int(inverse_bytesub[i >> 4][i & 0xf], 16) for i in range(256)]
+
+def _rotr8(word):
+    return ((word >> 8) | (word << 24)) & 0xffffffff
+
+# Combined SubBytes + MixColumns round tables. Entry x of te0 is the column
+# (2*S[x], S[x], S[x], 3*S[x]) packed big-endian into a 32-bit word; te1..te3
+# are the same table rotated for the other three rows of the state.
+te0 = [(mixcolumn_table2[s] << 24) | (s << 16) | (s << 8) | mixcolumn_table3[s] for s in sbox]
+te1 = [_rotr8(w) for w in te0]
+te2 = [_rotr8(w) for w in te1]
+te3 = [_rotr8(w) for w in te2]
+
+# Combined InvSubBytes + InvMixColumns round tables for the equivalent inverse cipher.
+# Entry x of td0 is the column (14*S'[x], 9*S'[x], 13*S'[x], 11*S'[x]) where S' is the
+# inverse S-box; td1..td3 are its rotations.
+td0 = [(mixcolumn_table14[s] << 24) | (mixcolumn_table9[s] << 16) | (mixcolumn_table13[s] << 8) | mixcolumn_table11[s]
+       for s in inv_sbox]
+td1 = [_rotr8(w) for w in td0]
+td2 = [_rotr8(w) for w in td1]
+td3 = [_rotr8(w) for w in td2]
+
+# Byte index feeding position i of the state after an inverse shift rows, for the
+# flat (column major) 16-byte state.
+inv_shift_index = [(i % 4) + 4 * ((i // 4 - i % 4) % 4) for i in range(16)]
+
+# Lookup arrays for the NumPy batch engine, which keeps N blocks as an N x 16 array
+# of bytes and applies every step to all of them at once.
+if numpy is not None:
+    np_sbox = numpy.array(sbox, dtype=numpy.uint8)
+    np_inv_sbox = numpy.array(inv_sbox, dtype=numpy.uint8)
+    np_mul2 = numpy.array(mixcolumn_table2, dtype=numpy.uint8)
+    np_mul3 = numpy.array(mixcolumn_table3, dtype=numpy.uint8)
+    np_mul9 = numpy.array(mixcolumn_table9, dtype=numpy.uint8)
+    np_mul11 = numpy.array(mixcolumn_table11, dtype=numpy.uint8)
+    np_mul13 = numpy.array(mixcolumn_table13, dtype=numpy.uint8)
+    np_mul14 = numpy.array(mixcolumn_table14, dtype=numpy.uint8)
+    np_shift_index = numpy.array([(i % 4) + 4 * ((i // 4 + i % 4) % 4) for i in range(16)])
+    np_inv_shift_index = numpy.array(inv_shift_index)
+
 def bytesub(hex_val, inv=False):
     """Performs the bytesub operation for a single byte, replacing it using a table lookup.
 
@@ -281,7 +376,7 @@ def form_extended_key(original_key):
     for j in range(10):
         t = ekey[-4:]
         t = rot_list(t, -1)
-        t = list(map(lambda x: int(bytesub(x), 16), t))
+        t = [sbox[x] for x in t]
         t[0] = t[0] ^ rcon[i]
         i += 1
         for byte1, byte2 in zip(t, ekey[-16:-12]):
@@ -335,11 +430,12 @@ def create_stream(state):
             stream[row + 4*col] = state[row][col]
     return stream
 
-def aes_singleblock(dat, ekey):
-    """Performs the AES encryption algorithm for a single 4x4 byte block of data, with a given extended key.
+def aes_singleblock_reference(dat, ekey):
+    """Performs the AES encryption algorithm for a single block using the step-by-step 4x4 state
+    operations. This is the straightforward reference version of aes_singleblock.
 
     Arguments:
-    dat -- A list of lists of bytes (as integers), 4x4 block of data.
+    dat -- A list of 16 bytes (as integers).
     ekey -- The extended key created by a key schedule algorithm, 176 bytes of data as a list of integers.
 
     Returns the ciphertext produced for the given block of data and extended key.
@@ -355,11 +451,12 @@ def aes_singleblock(dat, ekey):
         
     return create_stream(dat)
 
-def aes_singleblock_inverse(dat, ekey):
-    """Performs the AES decryption algorithm for a 4x4 byte block of ciphertext, with a given extended key.
+def aes_singleblock_inverse_reference(dat, ekey):
+    """Performs the AES decryption algorithm for a single block using the step-by-step 4x4 state
+    operations. This is the straightforward reference version of aes_singleblock_inverse.
 
     Arguments:
-    dat -- A list of lists of bytes (as integers), 4x4 block of data.
+    dat -- A list of 16 bytes (as integers).
     ekey -- The extended key created by a key schedule algorithm, 176 bytes of data as a list of integers.
 
     Returns the plaintext from the given ciphertext and key.
@@ -370,6 +467,925 @@ def aes_singleblock_inverse(dat, ekey):
         dat = bytesub_transform(shift_row(mix_columns(add_round_key(dat, ekey[(i+1)*16:(i+2)*16]), True), True), True)
     return create_stream(add_round_key(dat, ekey[:16]))
 
+def stream_to_words(stream):
+    """Packs a flat list of bytes into the 32-bit words used by the table-driven engine.
+
+    Arguments:
+    stream -- A list of bytes (as integers) whose length is a multiple of 4, such as a
+              block of data or the extended key.
+
+    Returns a list of integers, one big-endian word per 4 bytes (one per state column).
+    """
+    return [(stream[i] << 24) | (stream[i+1] << 16) | (stream[i+2] << 8) | stream[i+3]
+            for i in range(0, len(stream), 4)]
+
+def encrypt_block_words(s0, s1, s2, s3, rk):
+    """Encrypts a single block held as four big-endian column words.
+
+    Each of the first nine rounds is 16 lookups into the combined te0..te3 tables
+    plus the round key; the last round uses the plain S-box since it has no mix columns.
+
+    Arguments:
+    s0, s1, s2, s3 -- The columns of the input block as 32-bit integers.
+    rk -- Round key words from round_key_words.
+
+    Returns the four columns of the ciphertext as a tuple of 32-bit integers.
+    """
+    s0 ^= rk[0]
+    s1 ^= rk[1]
+    s2 ^= rk[2]
+    s3 ^= rk[3]
+    for r in range(4, 40, 4):
+        t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xff] ^ te2[(s2 >> 8) & 0xff] ^ te3[s3 & 0xff] ^ rk[r]
+        t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xff] ^ te2[(s3 >> 8) & 0xff] ^ te3[s0 & 0xff] ^ rk[r+1]
+        t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xff] ^ te2[(s0 >> 8) & 0xff] ^ te3[s1 & 0xff] ^ rk[r+2]
+        s3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xff] ^ te2[(s1 >> 8) & 0xff] ^ te3[s2 & 0xff] ^ rk[r+3]
+        s0, s1, s2 = t0, t1, t2
+    return ((sbox[s0 >> 24] << 24 | sbox[(s1 >> 16) & 0xff] << 16 | sbox[(s2 >> 8) & 0xff] << 8 | sbox[s3 & 0xff]) ^ rk[40],
+            (sbox[s1 >> 24] << 24 | sbox[(s2 >> 16) & 0xff] << 16 | sbox[(s3 >> 8) & 0xff] << 8 | sbox[s0 & 0xff]) ^ rk[41],
+            (sbox[s2 >> 24] << 24 | sbox[(s3 >> 16) & 0xff] << 16 | sbox[(s0 >> 8) & 0xff] << 8 | sbox[s1 & 0xff]) ^ rk[42],
+            (sbox[s3 >> 24] << 24 | sbox[(s0 >> 16) & 0xff] << 16 | sbox[(s1 >> 8) & 0xff] << 8 | sbox[s2 & 0xff]) ^ rk[43])
+
+def inverse_round_key_words(rk):
+    """Builds the decryption key schedule of the equivalent inverse cipher from the encryption one.
+
+    The round keys are taken in reverse order and inverse mix columns is applied to all but
+    the first and last, which lets decryption use the same structure of combined table
+    lookups as encryption. This is computed once per key by KeySchedule.
+
+    Arguments:
+    rk -- The extended key packed into 44 words by stream_to_words.
+
+    Returns the 44 decryption round key words for decrypt_block_words.
+    """
+    dk = list(rk[40:44])
+    for r in range(36, 0, -4):
+        dk += [td0[sbox[w >> 24]] ^ td1[sbox[(w >> 16) & 0xff]] ^ td2[sbox[(w >> 8) & 0xff]] ^ td3[sbox[w & 0xff]]
+               for w in rk[r:r+4]]
+    return dk + list(rk[0:4])
+
+def decrypt_block_words(s0, s1, s2, s3, dk):
+    """Decrypts a single block held as four big-endian column words with the equivalent
+    inverse cipher, mirroring encrypt_block_words with the td0..td3 tables.
+
+    Arguments:
+    s0, s1, s2, s3 -- The columns of the ciphertext block as 32-bit integers.
+    dk -- Decryption round key words from inverse_round_key_words.
+
+    Returns the four columns of the plaintext as a tuple of 32-bit integers.
+    """
+    s0 ^= dk[0]
+    s1 ^= dk[1]
+    s2 ^= dk[2]
+    s3 ^= dk[3]
+    for r in range(4, 40, 4):
+        t0 = td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xff] ^ td2[(s2 >> 8) & 0xff] ^ td3[s1 & 0xff] ^ dk[r]
+        t1 = td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xff] ^ td2[(s3 >> 8) & 0xff] ^ td3[s2 & 0xff] ^ dk[r+1]
+        t2 = td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xff] ^ td2[(s0 >> 8) & 0xff] ^ td3[s3 & 0xff] ^ dk[r+2]
+        s3 = td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xff] ^ td2[(s1 >> 8) & 0xff] ^ td3[s0 & 0xff] ^ dk[r+3]
+        s0, s1, s2 = t0, t1, t2
+    return ((inv_sbox[s0 >> 24] << 24 | inv_sbox[(s3 >> 16) & 0xff] << 16 | inv_sbox[(s2 >> 8) & 0xff] << 8 | inv_sbox[s1 & 0xff]) ^ dk[40],
+            (inv_sbox[s1 >> 24] << 24 | inv_sbox[(s0 >> 16) & 0xff] << 16 | inv_sbox[(s3 >> 8) & 0xff] << 8 | inv_sbox[s2 & 0xff]) ^ dk[41],
+            (inv_sbox[s2 >> 24] << 24 | inv_sbox[(s1 >> 16) & 0xff] << 16 | inv_sbox[(s0 >> 8) & 0xff] << 8 | inv_sbox[s3 & 0xff]) ^ dk[42],
+            (inv_sbox[s3 >> 24] << 24 | inv_sbox[(s2 >> 16) & 0xff] << 16 | inv_sbox[(s1 >> 8) & 0xff] << 8 | inv_sbox[s0 & 0xff]) ^ dk[43])
+
+def numpy_mix_columns(state, inv=False):
+    """Performs the (inverse) mix columns operation on an N x 16 array of blocks."""
+    cols = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = cols[:, :, 0], cols[:, :, 1], cols[:, :, 2], cols[:, :, 3]
+    mixed = numpy.empty_like(cols)
+    if not inv:
+        mixed[:, :, 0] = np_mul2[a0] ^ np_mul3[a1] ^ a2 ^ a3
+        mixed[:, :, 1] = a0 ^ np_mul2[a1] ^ np_mul3[a2] ^ a3
+        mixed[:, :, 2] = a0 ^ a1 ^ np_mul2[a2] ^ np_mul3[a3]
+        mixed[:, :, 3] = np_mul3[a0] ^ a1 ^ a2 ^ np_mul2[a3]
+    else:
+        mixed[:, :, 0] = np_mul14[a0] ^ np_mul11[a1] ^ np_mul13[a2] ^ np_mul9[a3]
+        mixed[:, :, 1] = np_mul9[a0] ^ np_mul14[a1] ^ np_mul11[a2] ^ np_mul13[a3]
+        mixed[:, :, 2] = np_mul13[a0] ^ np_mul9[a1] ^ np_mul14[a2] ^ np_mul11[a3]
+        mixed[:, :, 3] = np_mul11[a0] ^ np_mul13[a1] ^ np_mul9[a2] ^ np_mul14[a3]
+    return mixed.reshape(-1, 16)
+
+def numpy_encrypt_blocks(ekey, dat):
+    """Encrypts every 16 byte block of dat independently (ECB) with the NumPy batch engine.
+
+    Arguments:
+    ekey -- The extended key, 176 bytes as a list of integers.
+    dat -- Bytes-like data whose length is a multiple of 16.
+
+    Returns the ciphertext blocks as an N x 16 uint8 array.
+    """
+    rk = numpy.array(ekey, dtype=numpy.uint8).reshape(11, 16)
+    state = numpy.frombuffer(dat, dtype=numpy.uint8).reshape(-1, 16) ^ rk[0]
+    for r in range(1, 10):
+        state = numpy_mix_columns(np_sbox[state][:, np_shift_index]) ^ rk[r]
+    return np_sbox[state][:, np_shift_index] ^ rk[10]
+
+def numpy_decrypt_blocks(dkey, dat):
+    """Decrypts every 16 byte block of dat independently (ECB) with the NumPy batch engine,
+    using the equivalent inverse cipher.
+
+    Arguments:
+    dkey -- The decryption round keys as 176 bytes, i.e. words_to_stream of KeySchedule.dec.
+    dat -- Bytes-like ciphertext whose length is a multiple of 16.
+
+    Returns the plaintext blocks as an N x 16 uint8 array.
+    """
+    dk = numpy.array(dkey, dtype=numpy.uint8).reshape(11, 16)
+    state = numpy.frombuffer(dat, dtype=numpy.uint8).reshape(-1, 16) ^ dk[0]
+    for r in range(1, 10):
+        state = numpy_mix_columns(np_inv_sbox[state][:, np_inv_shift_index], True) ^ dk[r]
+    return np_inv_sbox[state][:, np_inv_shift_index] ^ dk[10]
+
+def numpy_counter_blocks(counter, count):
+    """Returns count consecutive 128-bit big-endian counter blocks starting at counter, as bytes."""
+    lo = numpy.arange(count, dtype=numpy.uint64) + numpy.uint64(counter & 0xffffffffffffffff)
+    hi = numpy.full(count, (counter >> 64) & 0xffffffffffffffff, dtype=numpy.uint64)
+    # Carry into the high word where the low word wrapped around
+    hi += (lo < numpy.uint64(counter & 0xffffffffffffffff)).astype(numpy.uint64)
+    blocks = numpy.empty((count, 2), dtype='>u8')
+    blocks[:, 0] = hi
+    blocks[:, 1] = lo
+    return blocks.tobytes()
+
+def words_to_stream(words):
+    """Unpacks big-endian 32-bit words into a flat list of bytes."""
+    stream = []
+    for w in words:
+        stream += [w >> 24, (w >> 16) & 0xff, (w >> 8) & 0xff, w & 0xff]
+    return stream
+
+def aes_singleblock(dat, ekey):
+    """Performs the AES encryption algorithm for a single 16 byte block of data, with a given extended key.
+
+    Arguments:
+    dat -- A list of 16 bytes (as integers).
+    ekey -- The extended key created by a key schedule algorithm, 176 bytes of data as a list of integers.
+
+    Returns the ciphertext produced for the given block of data and extended key.
+    """
+    w = stream_to_words(dat)
+    # The first 16 bytes of the extended key are the key itself, so its round key words
+    # come from the schedule cache instead of being repacked on every call
+    rk = get_key_schedule(ekey[:16]).enc
+    return words_to_stream(encrypt_block_words(w[0], w[1], w[2], w[3], rk))
+
+def aes_singleblock_inverse(dat, ekey):
+    """Performs the AES decryption algorithm for a 16 byte block of ciphertext, with a given extended key.
+
+    Arguments:
+    dat -- A list of 16 bytes (as integers).
+    ekey -- The extended key created by a key schedule algorithm, 176 bytes of data as a list of integers.
+
+    Returns the plaintext from the given ciphertext and key.
+    """
+    w = stream_to_words(dat)
+    # The first 16 bytes of the extended key are the key itself, so its decryption
+    # round keys come from the schedule cache instead of being inverted on every call
+    dk = get_key_schedule(ekey[:16]).dec
+    return words_to_stream(decrypt_block_words(w[0], w[1], w[2], w[3], dk))
+
+def as_bytes(dat):
+    """Normalizes data given as a string, list of bytes or bytes-like object to bytes."""
+    if isinstance(dat, (bytes, bytearray, memoryview)):
+        return bytes(dat)
+    return bytes(ord(x) if isinstance(x, str) else x for x in dat)
+
+class KeySchedule(object):
+    """
+    The expanded round keys for a single 128-bit key, in the forms the encryption
+    and decryption paths consume them.
+
+    Attributes:
+    key -- The original key as bytes.
+    ekey -- The extended key as a list of 176 integers.
+    enc -- Encryption round keys, 44 words for encrypt_block_words.
+    dec -- Decryption round keys of the equivalent inverse cipher, 44 words for
+           decrypt_block_words.
+    """
+    def __init__(self, key):
+        if len(key) != 16:
+            raise TypeError('The key must be 16 bytes')
+        self.key = as_bytes(key)
+        self.ekey = form_extended_key(list(self.key))
+        self.enc = stream_to_words(self.ekey)
+        self.dec = inverse_round_key_words(self.enc)
+
+class KeyScheduleCache(object):
+    """
+    Thread-safe, bounded LRU cache of KeySchedule objects keyed by the key bytes.
+    Session and MAC keys are reused for every message, so expanding them once
+    takes the key schedule off the per-message path.
+    """
+    def __init__(self, max_size=KEY_SCHEDULE_CACHE_SIZE):
+        self.max_size = max_size
+        self._schedules = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the KeySchedule for key, expanding and caching it on a miss.
+        """
+        key = as_bytes(key)
+        with self._lock:
+            schedule = self._schedules.get(key)
+            if schedule is not None:
+                self._schedules.move_to_end(key)
+                return schedule
+        # Expand outside the lock; two threads racing on the same new key just
+        # produce identical schedules.
+        schedule = KeySchedule(key)
+        with self._lock:
+            self._schedules[key] = schedule
+            self._schedules.move_to_end(key)
+            while len(self._schedules) > self.max_size:
+                self._schedules.popitem(last=False)
+        return schedule
+
+    def invalidate(self, key=None):
+        """
+        Removes key from the cache, or every cached schedule if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._schedules.clear()
+            else:
+                self._schedules.pop(as_bytes(key), None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._schedules)
+
+_key_schedules = KeyScheduleCache()
+
+def get_key_schedule(key):
+    """Returns the cached KeySchedule for key (a string, list of bytes or bytes)."""
+    return _key_schedules.get(key)
+
+def invalidate_key_schedule(key=None):
+    """
+    Forgets the cached round keys of key, or of every key if key is None. Call this
+    when a key is retired (rekey or disconnect) so it does not linger in memory.
+    """
+    _key_schedules.invalidate(key)
+
+class Engine(object):
+    """
+    Base class of the block cipher engines behind the modes in this module. An engine takes
+    a KeySchedule and bytes-like data made of whole 16 byte blocks, and returns bytes.
+    Subclasses implement encrypt_blocks and decrypt_blocks, and may override cbc_encrypt
+    with something faster than one encrypt_blocks call per block.
+    """
+    name = None
+
+    def is_available(self):
+        """Returns whether the engine can run in this interpreter."""
+        return True
+
+    def encrypt_blocks(self, schedule, dat):
+        """Encrypts every block of dat independently (ECB). Returns the ciphertext as bytes."""
+        raise NotImplementedError
+
+    def decrypt_blocks(self, schedule, dat):
+        """Decrypts every block of dat independently (ECB). Returns the plaintext as bytes."""
+        raise NotImplementedError
+
+    def cbc_encrypt(self, schedule, chain, dat):
+        """
+        Encrypts the blocks of dat in CBC mode, chaining from the 16 byte block chain
+        (the IV or the previous ciphertext block). Returns the ciphertext as bytes.
+        """
+        out = bytearray(len(dat))
+        for i in range(0, len(dat), 16):
+            xor_into(memoryview(dat)[i:i+16], chain, out, i)
+            chain = self.encrypt_blocks(schedule, out[i:i+16])
+            out[i:i+16] = chain
+        return bytes(out)
+
+class ReferenceEngine(Engine):
+    """The step-by-step 4x4 state implementation. Slow, but easy to check against FIPS-197."""
+    name = 'reference'
+
+    def encrypt_blocks(self, schedule, dat):
+        dat = bytes(dat)
+        return bytes(b for i in range(0, len(dat), 16)
+                     for b in aes_singleblock_reference(list(dat[i:i+16]), schedule.ekey))
+
+    def decrypt_blocks(self, schedule, dat):
+        dat = bytes(dat)
+        return bytes(b for i in range(0, len(dat), 16)
+                     for b in aes_singleblock_inverse_reference(list(dat[i:i+16]), schedule.ekey))
+
+class TableEngine(Engine):
+    """The pure Python table-driven engine working on 32-bit column words."""
+    name = 'table'
+
+    def encrypt_blocks(self, schedule, dat):
+        enc = schedule.enc
+        pack_into, unpack_from = block_struct.pack_into, block_struct.unpack_from
+        out = bytearray(len(dat))
+        for i in range(0, len(dat), 16):
+            pack_into(out, i, *encrypt_block_words(*unpack_from(dat, i), enc))
+        return bytes(out)
+
+    def decrypt_blocks(self, schedule, dat):
+        dec = schedule.dec
+        pack_into, unpack_from = block_struct.pack_into, block_struct.unpack_from
+        out = bytearray(len(dat))
+        for i in range(0, len(dat), 16):
+            pack_into(out, i, *decrypt_block_words(*unpack_from(dat, i), dec))
+        return bytes(out)
+
+    def cbc_encrypt(self, schedule, chain, dat):
+        enc = schedule.enc
+        pack_into, unpack_from = block_struct.pack_into, block_struct.unpack_from
+        c0, c1, c2, c3 = block_struct.unpack(chain)
+        out = bytearray(len(dat))
+        for i in range(0, len(dat), 16):
+            d0, d1, d2, d3 = unpack_from(dat, i)
+            c0, c1, c2, c3 = encrypt_block_words(d0 ^ c0, d1 ^ c1, d2 ^ c2, d3 ^ c3, enc)
+            pack_into(out, i, c0, c1, c2, c3)
+        return bytes(out)
+
+class NumpyEngine(TableEngine):
+    """
+    The NumPy batch engine for independent blocks. Batches under NUMPY_MIN_BLOCKS blocks and
+    CBC encryption, which is inherently serial, use the table-driven engine.
+    """
+    name = 'numpy'
+
+    def is_available(self):
+        return numpy is not None
+
+    def encrypt_blocks(self, schedule, dat):
+        if len(dat) // 16 < NUMPY_MIN_BLOCKS:
+            return TableEngine.encrypt_blocks(self, schedule, dat)
+        return numpy_encrypt_blocks(schedule.ekey, dat).tobytes()
+
+    def decrypt_blocks(self, schedule, dat):
+        if len(dat) // 16 < NUMPY_MIN_BLOCKS:
+            return TableEngine.decrypt_blocks(self, schedule, dat)
+        return numpy_decrypt_blocks(words_to_stream(schedule.dec), dat).tobytes()
+
+class CryptographyEngine(Engine):
+    """The system OpenSSL implementation, used through the cryptography package if installed."""
+    name = 'cryptography'
+
+    def is_available(self):
+        return Cipher is not None
+
+    def encrypt_blocks(self, schedule, dat):
+        return Cipher(algorithms.AES(schedule.key), modes.ECB()).encryptor().update(dat)
+
+    def decrypt_blocks(self, schedule, dat):
+        return Cipher(algorithms.AES(schedule.key), modes.ECB()).decryptor().update(dat)
+
+    def cbc_encrypt(self, schedule, chain, dat):
+        return Cipher(algorithms.AES(schedule.key), modes.CBC(bytes(chain))).encryptor().update(dat)
+
+# Known-answer tests run against an engine before it can be selected, as
+# (key, plaintext, ciphertext) in hex: FIPS-197 appendix C.1 and SP 800-38A F.1.1.
+KNOWN_ANSWERS = [('000102030405060708090a0b0c0d0e0f', '00112233445566778899aabbccddeeff', '69c4e0d86a7b0430d8cdb78070b4c55a'),
+                 ('2b7e151628aed2a6abf7158809cf4f3c', '6bc1bee22e409f96e93d7e117393172a', '3ad77bb40d7a3660a89ecaf32466ef97')]
+
+# SP 800-38A F.2.1 CBC-AES128 as (key, iv, plaintext, ciphertext) in hex
+KNOWN_ANSWER_CBC = ('2b7e151628aed2a6abf7158809cf4f3c', '000102030405060708090a0b0c0d0e0f',
+                    '6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51',
+                    '7649abac8119b246cee98e9b12e9197d5086cb9b507219ee95db113a917678b2')
+
+# Number of blocks the startup micro-benchmark encrypts and decrypts with each engine
+ENGINE_BENCHMARK_BLOCKS = 256
+
+# Environment variable naming the engine to use, skipping automatic selection
+ENGINE_ENV_VAR = 'VPN_AES_ENGINE'
+
+# Where the result of automatic selection is kept between runs
+ENGINE_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'a3-vpn', 'aes_engine.json')
+
+# Bump to invalidate cached selections when the engines change
+ENGINE_CACHE_VERSION = 1
+
+_engines = collections.OrderedDict()
+_engine = None
+_engine_lock = threading.RLock()
+
+def register_engine(engine):
+    """Adds an Engine instance to the registry, replacing any engine with the same name."""
+    with _engine_lock:
+        _engines[engine.name] = engine
+
+def get_engine_by_name(name):
+    """Returns the registered engine called name. Raises ValueError if there is none."""
+    engine = _engines.get(name)
+    if engine is None:
+        raise ValueError('Unknown AES engine: {}'.format(name))
+    return engine
+
+def available_engines():
+    """Returns the names of the registered engines that can run in this interpreter."""
+    return [name for name, engine in _engines.items() if engine.is_available()]
+
+def self_test(engine):
+    """
+    Runs the known-answer tests against engine, on single blocks, a batch large enough for
+    the vectorized paths, and CBC mode.
+
+    Returns True if every answer matched.
+    """
+    try:
+        for key, plaintext, ciphertext in KNOWN_ANSWERS:
+            schedule = KeySchedule(bytes.fromhex(key))
+            plaintext, ciphertext = bytes.fromhex(plaintext), bytes.fromhex(ciphertext)
+            if engine.encrypt_blocks(schedule, plaintext) != ciphertext:
+                return False
+            if engine.decrypt_blocks(schedule, ciphertext) != plaintext:
+                return False
+            if engine.encrypt_blocks(schedule, plaintext * 64) != ciphertext * 64:
+                return False
+            if engine.decrypt_blocks(schedule, ciphertext * 64) != plaintext * 64:
+                return False
+        key, iv, plaintext, ciphertext = [bytes.fromhex(x) for x in KNOWN_ANSWER_CBC]
+        return engine.cbc_encrypt(KeySchedule(key), iv, plaintext) == ciphertext
+    except Exception:
+        return False
+
+def benchmark_engine(engine, blocks=ENGINE_BENCHMARK_BLOCKS):
+    """Returns the seconds engine takes to encrypt, decrypt and CBC encrypt blocks blocks."""
+    schedule = KeySchedule(bytes(range(16)))
+    dat = bytes(range(256)) * (blocks // 16) + bytes(16 * (blocks % 16))
+    start = time.perf_counter()
+    engine.decrypt_blocks(schedule, engine.encrypt_blocks(schedule, dat))
+    engine.cbc_encrypt(schedule, bytes(16), dat)
+    return time.perf_counter() - start
+
+def _engine_fingerprint():
+    return {'version': ENGINE_CACHE_VERSION, 'python': sys.version, 'engines': available_engines()}
+
+def _read_engine_cache():
+    try:
+        with open(ENGINE_CACHE_FILE) as cache:
+            cached = json.load(cache)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('fingerprint') != _engine_fingerprint():
+        return None
+    return cached.get('engine')
+
+def _write_engine_cache(name, timings):
+    try:
+        os.makedirs(os.path.dirname(ENGINE_CACHE_FILE), exist_ok=True)
+        with open(ENGINE_CACHE_FILE, 'w') as cache:
+            json.dump({'fingerprint': _engine_fingerprint(), 'engine': name, 'timings': timings}, cache)
+    except OSError:
+        pass
+
+def set_engine(name):
+    """
+    Makes the engine called name the one used by every mode in this module.
+    Raises ValueError if it is unknown, unavailable or fails its self-test.
+    """
+    global _engine
+    engine = get_engine_by_name(name)
+    if not engine.is_available():
+        raise ValueError('AES engine {} is not available'.format(name))
+    if not self_test(engine):
+        raise ValueError('AES engine {} failed its self-test'.format(name))
+    with _engine_lock:
+        _engine = engine
+    return engine
+
+def select_engine(refresh=False):
+    """
+    Chooses the engine used by the modes in this module, in order of preference:
+    the engine named by the VPN_AES_ENGINE environment variable, the engine recorded in
+    ENGINE_CACHE_FILE for this interpreter and set of engines, or the fastest available
+    engine passing its self-test, which is then recorded in ENGINE_CACHE_FILE.
+
+    Arguments:
+    refresh -- If True, ignore the cached choice and probe the engines again.
+
+    Returns the selected engine.
+    """
+    global _engine
+    with _engine_lock:
+        name = os.environ.get(ENGINE_ENV_VAR)
+        if name:
+            return set_engine(name)
+        name = None if refresh else _read_engine_cache()
+        if name in _engines:
+            _engine = _engines[name]
+            return _engine
+        timings = {}
+        for name in available_engines():
+            engine = _engines[name]
+            if self_test(engine):
+                timings[name] = benchmark_engine(engine)
+        if not timings:
+            raise RuntimeError('No AES engine passed its self-test')
+        name = min(timings, key=timings.get)
+        _write_engine_cache(name, timings)
+        _engine = _engines[name]
+        return _engine
+
+def get_engine():
+    """Returns the engine used by the modes in this module, selecting one on first use."""
+    engine = _engine
+    if engine is None:
+        engine = select_engine()
+    return engine
+
+register_engine(ReferenceEngine())
+register_engine(TableEngine())
+register_engine(NumpyEngine())
+register_engine(CryptographyEngine())
+
+def xor_into(src, pad, out, out_offset=0):
+    """XORs src with the start of pad into out, as one big integer operation."""
+    length = len(src)
+    if length:
+        mixed = int.from_bytes(src, 'big') ^ int.from_bytes(memoryview(pad)[:length], 'big')
+        out[out_offset:out_offset + length] = mixed.to_bytes(length, 'big')
+
+def counter_blocks(counter, count):
+    """Returns count consecutive 128-bit big-endian counter blocks starting at counter, as bytes."""
+    if numpy is not None:
+        return numpy_counter_blocks(counter, count)
+    return b''.join(((counter + n) & 0xffffffffffffffffffffffffffffffff).to_bytes(16, 'big')
+                    for n in range(count))
+
+def cbc_encrypted_length(data_length):
+    """Returns the number of bytes (IV included) that aes_encrypt_into writes for data_length bytes."""
+    return 16 + (data_length + 15) // 16 * 16
+
+def gen_iv():
+    """Returns a new random 16 byte initialization vector from the OS CSPRNG."""
+    return os.urandom(16)
+
+def aes_encrypt_into(dat, key, out, iv=None):
+    """Performs AES-CBC encryption of a bytes-like object directly into a caller-supplied buffer.
+    The output format is the same as aes_encrypt: the IV followed by the ciphertext, with a short
+    last block padded with 0x80. No per-byte Python objects are created along the way.
+
+    Arguments:
+    dat -- Plaintext as any object supporting the buffer protocol (bytes, bytearray, memoryview, mmap).
+    key -- Key as a list of bytes, a string or bytes. Must contain 16 elements (128 bits).
+    out -- Writable buffer (e.g. a bytearray) of at least cbc_encrypted_length(len(dat)) bytes.
+    iv -- 16 byte initialization vector; a random one is generated if not given.
+
+    Returns the number of bytes written to out.
+    """
+    src = memoryview(dat).cast('B')
+    length = len(src)
+    total = cbc_encrypted_length(length)
+    if len(out) < total:
+        raise ValueError('The output buffer must hold at least {} bytes'.format(total))
+    if iv is None:
+        iv = gen_iv()
+    elif len(iv) != 16:
+        raise TypeError('The key/iv must be 16 bytes')
+    schedule = get_key_schedule(key)
+    out[:16] = as_bytes(iv)
+    full = length - length % 16
+    chain = cbc_encrypt_range(schedule, out[:16], src, 0, full, out, 16)
+    if full < length:
+        cbc_encrypt_range(schedule, chain, pad_block(src[full:]), 0, 16, out, full + 16)
+    return total
+
+def pad_block(tail):
+    """Pads the final partial block tail (under 16 bytes) with 0x80 up to a full block."""
+    return bytes(tail) + bytes([0x80]) * (16 - len(tail))
+
+def cbc_encrypt_range(schedule, chain, src, start, end, out, out_offset):
+    """Encrypts the whole blocks src[start:end] in CBC mode into out.
+
+    Arguments:
+    schedule -- KeySchedule of the key.
+    chain -- The previous ciphertext block (or IV), 16 bytes.
+    src -- Bytes-like plaintext.
+    start, end -- Byte offsets of the blocks to encrypt; end - start must be a multiple of 16.
+    out -- Writable buffer receiving the ciphertext.
+    out_offset -- Position in out where the ciphertext of the block at start is written.
+
+    Returns the last ciphertext block as bytes, to chain the next call from.
+    """
+    if end == start:
+        return bytes(chain)
+    ciphertext = get_engine().cbc_encrypt(schedule, chain, memoryview(src)[start:end])
+    out[out_offset:out_offset + end - start] = ciphertext
+    return ciphertext[-16:]
+
+def cbc_decrypt_range(schedule, src, start, end, out, out_offset=0, engine=None):
+    """Decrypts the CBC blocks src[start:end] into out. Each block only depends on itself and the
+    ciphertext block before it, so disjoint ranges can be decrypted independently.
+
+    Arguments:
+    schedule -- KeySchedule of the key.
+    src -- Bytes-like IV and ciphertext; start must be at least 16 so the previous block exists.
+    start, end -- Byte offsets of the blocks to decrypt, multiples of 16.
+    out -- Writable buffer receiving the plaintext.
+    out_offset -- Position in out where the plaintext of the block at start is written.
+    engine -- Engine to use instead of the selected one.
+    """
+    if end == start:
+        return
+    src = memoryview(src)
+    plaintext = (engine or get_engine()).decrypt_blocks(schedule, src[start:end])
+    xor_into(plaintext, src[start-16:end-16], out, out_offset)
+
+def cbc_decrypt_chunk(engine_name, key, chunk):
+    """Process pool worker: decrypts every block of chunk after its first, which is the previous
+    ciphertext block (or IV). Returns the plaintext as a bytearray."""
+    plaintext = bytearray(len(chunk) - 16)
+    cbc_decrypt_range(get_key_schedule(key), chunk, 16, len(chunk), plaintext, 0,
+                      get_engine_by_name(engine_name))
+    return plaintext
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    """Returns the shared worker pool used for parallel modes, starting it (one process per
+    core) on first use."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = multiprocessing.Pool(os.cpu_count())
+        return _process_pool
+
+def close_process_pool():
+    """Shuts down the shared worker pool, if it was started."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.terminate()
+            _process_pool.join()
+            _process_pool = None
+
+def split_block_ranges(start, end, parts):
+    """Splits the byte range [start, end) of whole 16 byte blocks into at most parts
+    contiguous ranges of nearly equal size. Returns a list of (start, end) tuples."""
+    blocks = (end - start) // 16
+    parts = max(1, min(parts, blocks))
+    ranges = []
+    for n in range(parts):
+        lo = start + blocks * n // parts * 16
+        hi = start + blocks * (n + 1) // parts * 16
+        ranges.append((lo, hi))
+    return ranges
+
+def aes_decrypt_into(dat, key, out, processes=1):
+    """Performs AES-CBC decryption of a bytes-like object directly into a caller-supplied buffer.
+
+    Arguments:
+    dat -- IV followed by ciphertext, as any object supporting the buffer protocol.
+    key -- Key as a list of bytes, a string or bytes. Must contain 16 elements (128 bits).
+    out -- Writable buffer (e.g. a bytearray) of at least len(dat) - 16 bytes.
+    processes -- Number of block ranges to decrypt in parallel in the shared process pool. None
+                 uses one per core. Ciphertexts under PARALLEL_MIN_BLOCKS blocks are always
+                 decrypted in-process.
+
+    Returns the length of the plaintext written to out, with the 0x80 padding excluded.
+    """
+    src = memoryview(dat).cast('B')
+    length = len(src)
+    if length == 0 or length % 16:
+        raise ValueError('The ciphertext must be a non-zero whole number of 16 byte blocks')
+    if len(out) < length - 16:
+        raise ValueError('The output buffer must hold at least {} bytes'.format(length - 16))
+    schedule = get_key_schedule(key)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and length // 16 - 1 >= PARALLEL_MIN_BLOCKS:
+        engine_name = get_engine().name
+        ranges = split_block_ranges(16, length, processes)
+        chunks = [(engine_name, schedule.key, bytes(src[lo-16:hi])) for lo, hi in ranges]
+        for (lo, hi), plaintext in zip(ranges, get_process_pool().starmap(cbc_decrypt_chunk, chunks)):
+            out[lo-16:hi-16] = plaintext
+    else:
+        cbc_decrypt_range(schedule, src, 16, length, out)
+    end = length - 16
+    while end > 0 and out[end - 1] == 0x80:
+        end -= 1
+    return end
+
+class Encryptor(object):
+    """
+    Incremental AES-CBC encryption. Feeding chunks to update() and then calling finalize()
+    yields exactly the output of aes_encrypt_into on their concatenation (IV first), but
+    ciphertext for each full block is returned as soon as it is available and at most one
+    partial block is buffered, so large payloads can be sent with bounded memory.
+    """
+    def __init__(self, key, iv=None):
+        if iv is None:
+            iv = gen_iv()
+        elif len(iv) != 16:
+            raise TypeError('The key/iv must be 16 bytes')
+        self.schedule = get_key_schedule(key)
+        self.iv = as_bytes(iv)
+        self.chain = self.iv
+        self.pending = bytearray()
+        self.iv_sent = False
+        self.finalized = False
+
+    def update(self, dat):
+        """
+        Adds a chunk of plaintext (any bytes-like object).
+
+        Returns the ciphertext of every block completed so far as bytes; the first call
+        also returns the IV in front of it.
+        """
+        if self.finalized:
+            raise ValueError('The encryptor has already been finalized')
+        self.pending += memoryview(dat).cast('B')
+        full = len(self.pending) - len(self.pending) % 16
+        return self._emit(self.pending, full)
+
+    def finalize(self):
+        """
+        Pads and encrypts any buffered partial block.
+
+        Returns the remaining ciphertext as bytes. The encryptor cannot be used afterwards.
+        """
+        if self.finalized:
+            raise ValueError('The encryptor has already been finalized')
+        self.finalized = True
+        if self.pending:
+            self.pending = bytearray(pad_block(self.pending))
+        return self._emit(self.pending, len(self.pending))
+
+    def _emit(self, src, end):
+        header = 0 if self.iv_sent else 16
+        out = bytearray(header + end)
+        if header:
+            out[:16] = self.iv
+            self.iv_sent = True
+        self.chain = cbc_encrypt_range(self.schedule, self.chain, src, 0, end, out, header)
+        del self.pending[:end]
+        return bytes(out)
+
+class Decryptor(object):
+    """
+    Incremental AES-CBC decryption, the counterpart of Encryptor. Plaintext is returned as
+    soon as the blocks carrying it arrive, except for a trailing run of 0x80 bytes, which
+    is held back until it is known whether it is padding.
+    """
+    def __init__(self, key):
+        self.schedule = get_key_schedule(key)
+        self.pending = bytearray()
+        self.held = bytearray()
+        self.finalized = False
+
+    def update(self, dat):
+        """
+        Adds a chunk of IV and ciphertext (any bytes-like object).
+
+        Returns the plaintext that can be released so far as bytes.
+        """
+        if self.finalized:
+            raise ValueError('The decryptor has already been finalized')
+        self.pending += memoryview(dat).cast('B')
+        # The first 16 bytes (the IV, later the last ciphertext block) are kept to chain from
+        full = len(self.pending) - len(self.pending) % 16
+        if full <= 16:
+            return b''
+        plaintext = self.held + bytearray(full - 16)
+        cbc_decrypt_range(self.schedule, self.pending, 16, full, plaintext, len(self.held))
+        del self.pending[:full - 16]
+        end = len(plaintext)
+        while end > 0 and plaintext[end - 1] == 0x80:
+            end -= 1
+        self.held = plaintext[end:]
+        return bytes(plaintext[:end])
+
+    def finalize(self):
+        """
+        Checks that the ciphertext ended on a block boundary and discards the padding.
+
+        Returns any remaining plaintext as bytes (always empty, as held back bytes are padding).
+        """
+        if self.finalized:
+            raise ValueError('The decryptor has already been finalized')
+        self.finalized = True
+        if len(self.pending) % 16:
+            raise ValueError('The ciphertext must be a whole number of 16 byte blocks')
+        self.held = bytearray()
+        return b''
+
+def ctr_keystream_range(engine_name, key, counter, count):
+    """Process pool worker: encrypts count consecutive counter blocks starting at counter.
+
+    Arguments:
+    engine_name -- Name of the engine to encrypt with.
+    key -- The key as bytes.
+    counter -- The first counter block as a 128-bit integer.
+    count -- Number of blocks to generate.
+
+    Returns count * 16 bytes of keystream.
+    """
+    return get_engine_by_name(engine_name).encrypt_blocks(get_key_schedule(key), counter_blocks(counter, count))
+
+def aes_ctr_keystream(key, iv, count, first_block=0, processes=1):
+    """Generates AES-CTR keystream. Every block is the encryption of iv + its index, so blocks can
+    be generated ahead of time, in any order, and split across worker processes.
+
+    Arguments:
+    key -- Key as a list of bytes, a string or bytes. Must contain 16 elements (128 bits).
+    iv -- 16 byte initial counter block.
+    count -- Number of 16 byte keystream blocks to generate.
+    first_block -- Index of the first block, to continue a keystream.
+    processes -- Number of ranges to generate in parallel in the shared process pool. None uses
+                 one per core. Fewer than PARALLEL_MIN_BLOCKS blocks are always generated in-process.
+
+    Returns the keystream as a bytearray of count * 16 bytes.
+    """
+    if len(iv) != 16:
+        raise TypeError('The key/iv must be 16 bytes')
+    schedule = get_key_schedule(key)
+    engine = get_engine()
+    counter = int.from_bytes(as_bytes(iv), 'big') + first_block
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and count >= PARALLEL_MIN_BLOCKS:
+        ranges = split_block_ranges(0, count * 16, processes)
+        args = [(engine.name, schedule.key, counter + lo // 16, (hi - lo) // 16) for lo, hi in ranges]
+        return bytearray().join(get_process_pool().starmap(ctr_keystream_range, args))
+    return bytearray(engine.encrypt_blocks(schedule, counter_blocks(counter, count)))
+
+def aes_ctr_encrypt_into(dat, key, out, iv=None, processes=1, keystream=None):
+    """Performs AES-CTR encryption of a bytes-like object into a caller-supplied buffer. Counter mode
+    needs no padding, so the output is the 16 byte IV followed by exactly len(dat) bytes.
+
+    Arguments:
+    dat -- Plaintext as any object supporting the buffer protocol.
+    key -- Key as a list of bytes, a string or bytes. Must contain 16 elements (128 bits).
+    out -- Writable buffer of at least len(dat) + 16 bytes.
+    iv -- 16 byte initial counter block; a random one is generated if not given. Never reuse
+          an iv with the same key.
+    processes -- Number of worker processes used to generate the keystream, see aes_ctr_keystream.
+    keystream -- Keystream for this key and iv precomputed with aes_ctr_keystream, at least
+                 len(dat) bytes long. Generated on the fly if not given.
+
+    Returns the number of bytes written to out.
+    """
+    src = memoryview(dat).cast('B')
+    length = len(src)
+    if len(out) < length + 16:
+        raise ValueError('The output buffer must hold at least {} bytes'.format(length + 16))
+    if iv is None:
+        iv = gen_iv()
+    if keystream is None:
+        keystream = aes_ctr_keystream(key, iv, (length + 15) // 16, processes=processes)
+    elif len(keystream) < length:
+        raise ValueError('The keystream is shorter than the data')
+    out[:16] = as_bytes(iv)
+    xor_into(src, keystream, out, 16)
+    return length + 16
+
+def aes_ctr_decrypt_into(dat, key, out, processes=1, keystream=None):
+    """Performs AES-CTR decryption of a bytes-like object into a caller-supplied buffer.
+
+    Arguments:
+    dat -- IV followed by ciphertext, as produced by aes_ctr_encrypt_into.
+    key -- Key as a list of bytes, a string or bytes. Must contain 16 elements (128 bits).
+    out -- Writable buffer of at least len(dat) - 16 bytes.
+    processes -- Number of worker processes used to generate the keystream, see aes_ctr_keystream.
+    keystream -- Precomputed keystream for this key and iv, see aes_ctr_encrypt_into.
+
+    Returns the length of the plaintext written to out.
+    """
+    src = memoryview(dat).cast('B')
+    if len(src) < 16:
+        raise ValueError('The ciphertext must start with a 16 byte IV')
+    length = len(src) - 16
+    if len(out) < length:
+        raise ValueError('The output buffer must hold at least {} bytes'.format(length))
+    if keystream is None:
+        keystream = aes_ctr_keystream(key, src[:16], (length + 15) // 16, processes=processes)
+    elif len(keystream) < length:
+        raise ValueError('The keystream is shorter than the data')
+    xor_into(src[16:], keystream, out)
+    return length
+
+def aes_ctr_encrypt(dat, key, iv=None, processes=1):
+    """Performs AES-CTR encryption of dat (bytes-like, a list of bytes or a string).
+
+    Returns the IV followed by the ciphertext as bytes.
+    """
+    dat = as_bytes(dat)
+    ciphertext = bytearray(len(dat) + 16)
+    aes_ctr_encrypt_into(dat, key, ciphertext, iv, processes)
+    return bytes(ciphertext)
+
+def aes_ctr_decrypt(dat, key, processes=1):
+    """Performs AES-CTR decryption of an IV followed by ciphertext.
+
+    Returns the plaintext as bytes.
+    """
+    dat = as_bytes(dat)
+    plaintext = bytearray(max(len(dat) - 16, 0))
+    aes_ctr_decrypt_into(dat, key, plaintext, processes)
+    return bytes(plaintext)
+
 def aes_encrypt(dat, key, iv = None):
     """Performs the AES encryption algorithm for the given data and key. Uses CBC for data that is longer than
     128-bits. If the last block of data is under 128 bits, the data will be padded with 0x80.
@@ -384,22 +1400,10 @@ def aes_encrypt(dat, key, iv = None):
     
     if len(key) != 16 or (iv and len(iv) != 16):
         raise TypeError('The key/iv must be 16 bytes')
-    key = [ord(x) if isinstance(x, str) else x for x in key]
-    dat = [ord(x) if isinstance(x, str) else x for x in dat]
-    ekey = form_extended_key(key)
-    padding = int(math.ceil(len(dat) / 16.0)) * 16 - len(dat)
-    dat = dat + [0x80]*padding
-    # Generate the initialization vector
-    ciphertext = []
-    if not iv:
-        for i in range(16):
-            ciphertext.append(random.randint(0, 255))
-    else:
-        ciphertext += iv
-    for i in range(0, len(dat), 16):
-        block = [x ^ y for (x,y) in zip(dat[i:i+16], ciphertext[i:i+16])]
-        ciphertext += aes_singleblock(block, ekey)
-    return ciphertext
+    dat = as_bytes(dat)
+    ciphertext = bytearray(cbc_encrypted_length(len(dat)))
+    aes_encrypt_into(dat, key, ciphertext, iv or None)
+    return list(ciphertext)
 
 def trim_padding_chars(plaintext):
     while len(plaintext) > 0:
@@ -408,25 +1412,20 @@ def trim_padding_chars(plaintext):
             plaintext.append(end_char)
             break
 
-def aes_decrypt(dat, key):
+def aes_decrypt(dat, key, processes=1):
     """Performs the AES decryption algorithm for the given ciphertext and key, using CBC mode.
 
     Arguments:
     dat -- Ciphertext as a list of bytes or as a string.
     key -- Key as a list of bytes or as a string. Must contain 16 elements (128 bits).
+    processes -- Number of worker processes for large ciphertexts, see aes_decrypt_into.
 
     Returns the plaintext for the given ciphertext and key.
     """
     
     if len(key) != 16:
         raise TypeError('The key must be 16 bytes')
-    key = [ord(x) if isinstance(x, str) else x for x in key]
-    dat = [ord(x) if isinstance(x, str) else x for x in dat]
-    ekey = form_extended_key(key)
-    plaintext = []
-    for i in range(16, len(dat), 16):
-        block = aes_singleblock_inverse(dat[i:i+16], ekey)
-        plaintext += [x ^ y for (x,y) in zip(block, dat[i-16:i])]
-    trim_padding_chars(plaintext)
-    return plaintext
-
+    dat = as_bytes(dat)
+    plaintext = bytearray(max(len(dat) - 16, 0))
+    length = aes_decrypt_into(dat, key, plaintext, processes)
+    return list(plaintext[:length])
@@ -0,0 +1,268 @@
+"""
+asyncio VPN connector
+
+AsyncConnector offers the Connector contract (connect, send, receive, receive_wait,
+subscribe, close, is_alive) on an asyncio event loop, instead of a sender and a
+receiver thread per connection. It uses the same length-prefixed frames and reads
+them into a reused buffer through asyncio.BufferedProtocol, so an AsyncConnector can
+talk to a threaded Connector. Any number of connections share one loop, and
+start_server accepts as many tunnels as arrive.
+
+Sealing and opening frames is CPU work that would stall every connection on the
+loop. send_sealed and receive_opened therefore run the session keys in an executor.
+Handshake steps from handshake.HandshakeEngine can be awaited with
+asyncio.wrap_future.
+"""
+
+import asyncio
+import logging
+
+import connector
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Reads length-prefixed frames for an AsyncConnector. The event loop reads straight
+    into the FrameReader buffer.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.reader = connector.FrameReader()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn._connection_made(transport)
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        try:
+            for message in self.reader.frames():
+                self.conn._deliver(message)
+        except ValueError:
+            logging.getLogger().info('Dropping connection: frame too long')
+            self.transport.close()
+
+    def pause_writing(self):
+        self.conn.writable.clear()
+
+    def resume_writing(self):
+        self.conn.writable.set()
+
+    def connection_lost(self, exc):
+        self.conn._connection_lost(exc)
+
+class RejectProtocol(asyncio.Protocol):
+    """Closes every connection it is given; used once a single-peer server has its peer."""
+    def connection_made(self, transport):
+        transport.close()
+
+class AsyncConnector(object):
+    """
+    One framed connection on the running event loop. The methods that wait are
+    coroutines; send, subscribe and close return at once.
+    """
+    def __init__(self, server=False, host=connector.HOST, port=connector.PORT):
+        self.host = host
+        self.port = int(port)
+        self.server = server
+        self.transport = None
+        self.receive_queue = None
+        self.subscribers = []
+        self.connected = None
+        self.writable = None
+        self.on_connected = None
+
+    def _prepare(self):
+        self.receive_queue = asyncio.Queue()
+        self.connected = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def _connection_made(self, transport):
+        self.transport = transport
+        self.connected.set()
+        if self.on_connected is not None:
+            self.on_connected()
+
+    def _connection_lost(self, exc):
+        self.writable.set()
+        # Wake every waiting receive; None marks the end of the connection
+        self.receive_queue.put_nowait(None)
+
+    def _deliver(self, message):
+        if not self.subscribers:
+            self.receive_queue.put_nowait(message)
+            return
+        for callback in self.subscribers:
+            self._call(callback, message)
+
+    def _call(self, callback, message):
+        """
+        Calls a subscriber. One that raises is logged and the connection is kept, as
+        connector.Inbox does for the threaded transport.
+        """
+        try:
+            callback(message)
+        except Exception:
+            logging.getLogger().exception('Subscriber callback {!r} failed'.format(callback))
+
+    async def connect(self):
+        """
+        Establish a connection between two VPN instances. A server accepts the first
+        client that connects and refuses any others.
+        """
+        if self.is_alive():
+            return
+        loop = asyncio.get_running_loop()
+        self._prepare()
+        if self.server:
+            accepting = [True]
+
+            def factory():
+                if not accepting[0]:
+                    return RejectProtocol()
+                accepting[0] = False
+                return FrameProtocol(self)
+
+            listener = await loop.create_server(factory, self.host or None, self.port, reuse_address=True)
+            logging.getLogger().info('Waiting for connection...')
+            try:
+                await self.connected.wait()
+            finally:
+                listener.close()
+            logging.getLogger().info('Server is connected to client: ' + str(self.transport.get_extra_info('peername')[0]))
+        else:
+            logging.getLogger().info('Client is connecting to server: ' + self.host)
+            await loop.create_connection(lambda: FrameProtocol(self), self.host, self.port)
+
+    def send(self, message):
+        """
+        Send a message over the connection. Await drain to wait for buffered data to go out.
+        """
+        if len(message) > connector.MAX_FRAME_SIZE:
+            raise ValueError('Messages are limited to {} bytes'.format(connector.MAX_FRAME_SIZE))
+        if not self.is_alive():
+            raise connector.ConnectionDeadException('Lost connection')
+        self.transport.writelines([connector.frame_struct.pack(len(message)), bytes(message)])
+
+    async def drain(self):
+        """Waits until the transport's write buffer is below its high-water mark."""
+        await self.writable.wait()
+
+    async def receive(self, timeout=0):
+        """
+        Recieve a message over the connection
+        Arguments:
+            timeout - seconds to wait for a message; 0 returns at once, None waits
+                      for as long as it takes
+        Returns:
+            bytes received, or None if nothing arrived in time or the connection is closed
+        """
+        try:
+            if timeout == 0:
+                message = self.receive_queue.get_nowait()
+            else:
+                message = await asyncio.wait_for(self.receive_queue.get(), timeout)
+        except (asyncio.QueueEmpty, asyncio.TimeoutError):
+            return None
+        if message is None:
+            # Leave the end marker for any other waiting receive
+            self.receive_queue.put_nowait(None)
+        return message
+
+    async def receive_wait(self):
+        """
+        Waits until you receive something, then return it (None once the connection is closed)
+        """
+        return await self.receive(timeout=None)
+
+    def __aiter__(self):
+        return self._messages()
+
+    async def _messages(self):
+        """Yields messages as they arrive, until the connection is closed."""
+        while True:
+            message = await self.receive_wait()
+            if message is None:
+                return
+            yield message
+
+    def subscribe(self, callback):
+        """
+        Calls callback(message) on the loop for every message received from now on,
+        instead of queueing it. Messages already queued are handed over first.
+        """
+        self.subscribers.append(callback)
+        while not self.receive_queue.empty():
+            message = self.receive_queue.get_nowait()
+            if message is None:
+                self.receive_queue.put_nowait(None)
+                break
+            self._call(callback, message)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    async def send_sealed(self, session_keys, message, executor=None):
+        """
+        Seals message with session_keys (a kdf.SessionKeys) in executor (None for the
+        loop's default), then sends the frame and waits for the write buffer to drain.
+        Await each call before the next one on the same session.
+        """
+        frame = await asyncio.get_running_loop().run_in_executor(executor, session_keys.seal, message)
+        self.send(frame)
+        await self.drain()
+
+    async def receive_opened(self, session_keys, timeout=None, executor=None):
+        """
+        Receives frames and opens them with session_keys in executor, dropping any that
+        are not authentic.
+        Returns:
+            the next authentic message as bytes, or None if nothing arrived in time or the
+            connection is closed
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            frame = await self.receive(timeout)
+            if frame is None:
+                return None
+            message = await loop.run_in_executor(executor, session_keys.open, frame)
+            if message is not None:
+                return message
+            logging.getLogger().info('MAC check FAILURE')
+
+    def is_alive(self):
+        return self.transport is not None and not self.transport.is_closing()
+
+    def close(self):
+        logging.getLogger().info('Closing connection')
+        if self.transport is not None:
+            self.transport.close()
+
+async def start_server(handler, host=connector.HOST, port=connector.PORT):
+    """
+    Accepts any number of connections on the running loop. For each one, the
+    coroutine handler(conn) runs as a task with an AsyncConnector that is already
+    connected.
+
+    Returns the asyncio Server; close it to stop accepting.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    def factory():
+        conn = AsyncConnector(True, host, port)
+        conn._prepare()
+
+        def connected():
+            task = loop.create_task(handler(conn))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        conn.on_connected = connected
+        return FrameProtocol(conn)
+
+    return await loop.create_server(factory, host or None, port, reuse_address=True)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmarks for the AES and CBC-MAC hot paths, and for the Diffie-Hellman
+exponentiation (builtin pow against the fixed-base table).
+
+Every case reports blocks/s, MB/s and the bytes allocated per block (the tracemalloc
+peak of one run) as JSON. Results can be saved as a baseline and later runs compared
+against it, exiting with status 1 if any case got slower than the allowed tolerance.
+Timings only mean something on the machine that took them, so no baseline ships with
+the repository: --compare exits with status 2 until one is saved with --save-baseline.
+
+Usage:
+    python3 bench.py                      run and print the results
+    python3 bench.py --save-baseline      run and store the results as the baseline
+    python3 bench.py --compare            run and compare against the stored baseline
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import aes
+import dh_auth
+import mac
+
+BLOCK_SIZE_BYTES = 16
+
+# Payload sizes for the multi-block cases, 16 B to 16 MB
+PAYLOAD_SIZES = [16, 256, 4096, 65536, 1 << 20, 16 << 20]
+
+# Each case is repeated until it has run for at least this many seconds
+MIN_TIME = 0.2
+
+# Allowed slowdown against the baseline before a case counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+KEY = bytes(range(16))
+MAC_KEY = bytes(range(16, 32))
+IV = bytes(16)
+
+# A full length exponent of the size dh_auth draws, and the size of a public value
+DH_EXPONENT = (1 << 127) | 0x0123456789abcdef0123456789abcdef
+DH_BYTES = (dh_auth.prime.bit_length() + 7) // 8
+
+def size_label(size):
+    """Returns a short human readable label for a payload size."""
+    for unit, scale in (('M', 1 << 20), ('K', 1 << 10)):
+        if size >= scale and size % scale == 0:
+            return '{}{}'.format(size // scale, unit)
+    return str(size)
+
+def time_case(func, min_time=MIN_TIME):
+    """
+    Runs func repeatedly for at least min_time seconds.
+
+    Returns the fastest single run in seconds.
+    """
+    best = None
+    spent = 0.0
+    while spent < min_time or best is None:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        spent += elapsed
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def traced_peak(func):
+    """Returns the peak number of bytes allocated while running func once."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+def run_case(func, blocks, nbytes, min_time=MIN_TIME):
+    """
+    Measures a single benchmark case.
+
+    Arguments:
+    func -- Zero argument callable doing one unit of work.
+    blocks -- Number of AES blocks (or keys or exponentiations) one call processes.
+    nbytes -- Number of payload bytes one call processes.
+
+    Returns a dict of the measurements.
+    """
+    func()  # warm caches (key schedule, engine selection)
+    seconds = time_case(func, min_time)
+    return {'bytes': nbytes,
+            'blocks': blocks,
+            'seconds': seconds,
+            'blocks_per_s': blocks / seconds,
+            'mb_per_s': nbytes / seconds / 1e6,
+            'alloc_bytes_per_block': traced_peak(func) / blocks}
+
+def build_cases(max_size, pattern=None):
+    """
+    Returns a list of (name, func, blocks, nbytes) tuples for every benchmark case whose
+    name contains pattern (all if None), leaving out payloads larger than max_size.
+    Payloads are only built for sizes that have a case left to run.
+    """
+    def wanted(name):
+        return not pattern or pattern in name
+
+    ekey = aes.form_extended_key(list(KEY))
+    block = list(range(16))
+    cases = [('aes_singleblock', lambda: aes.aes_singleblock(block, ekey), 1, 16),
+             ('aes_singleblock_inverse', lambda: aes.aes_singleblock_inverse(block, ekey), 1, 16),
+             ('form_extended_key', lambda: aes.form_extended_key(list(KEY)), 1, 16),
+             ('dh_pow_builtin', lambda: pow(dh_auth.gen, DH_EXPONENT, dh_auth.prime), 1, DH_BYTES),
+             ('dh_pow_fixed_base', lambda: dh_auth.gen_pow.table_pow(DH_EXPONENT), 1, DH_BYTES)]
+    cases = [case for case in cases if wanted(case[0])]
+    for size in PAYLOAD_SIZES:
+        label = size_label(size)
+        names = [prefix + label for prefix in ('aes_encrypt/', 'aes_decrypt/', 'get_mac/', 'check_mac/')]
+        if size > max_size or not any(wanted(name) for name in names):
+            continue
+        blocks = size // BLOCK_SIZE_BYTES
+        plaintext = bytes(range(256)) * (size // 256) + bytes(size % 256)
+        ciphertext = aes.aes_encrypt(plaintext, KEY, list(IV))
+        tag = mac.get_mac(plaintext, MAC_KEY, list(IV))[1]
+
+        funcs = [lambda p=plaintext: aes.aes_encrypt(p, KEY, list(IV)),
+                 lambda c=ciphertext: aes.aes_decrypt(c, KEY),
+                 lambda p=plaintext: mac.get_mac(p, MAC_KEY, list(IV)),
+                 lambda p=plaintext, t=tag: mac.check_mac(p, t, MAC_KEY, list(IV))]
+        cases += [(name, func, blocks, size) for name, func in zip(names, funcs) if wanted(name)]
+    return cases
+
+def run_benchmarks(max_size=PAYLOAD_SIZES[-1], min_time=MIN_TIME, pattern=None):
+    """
+    Runs every benchmark case whose name contains pattern (all if None).
+
+    Returns the report as a dict with 'meta' and 'results' keys.
+    """
+    results = {}
+    for name, func, blocks, nbytes in build_cases(max_size, pattern):
+        results[name] = run_case(func, blocks, nbytes, min_time)
+    meta = {'python': sys.version,
+            'platform': platform.platform(),
+            'engine': aes.get_engine().name,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'meta': meta, 'results': results}
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares the blocks/s of every case in report with the same case in baseline.
+
+    Returns a list of regressions, one dict per case that is more than tolerance slower.
+    """
+    regressions = []
+    for name, result in report['results'].items():
+        reference = baseline.get('results', {}).get(name)
+        if reference is None:
+            continue
+        ratio = result['blocks_per_s'] / reference['blocks_per_s']
+        if ratio < 1.0 - tolerance:
+            regressions.append({'case': name,
+                                'blocks_per_s': result['blocks_per_s'],
+                                'baseline_blocks_per_s': reference['blocks_per_s'],
+                                'ratio': ratio})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the AES and CBC-MAC hot paths.')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results against the baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed slowdown as a fraction (default %(default)s)')
+    parser.add_argument('--max-size', type=int, default=PAYLOAD_SIZES[-1], help='largest payload in bytes')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='seconds to repeat each case for')
+    parser.add_argument('--filter', default=None, help='only run cases whose name contains this')
+    parser.add_argument('--engine', default=None, help='AES engine to benchmark (default: automatic)')
+    parser.add_argument('--output', default=None, help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        # Read the baseline first, so a missing one fails before minutes of benchmarking
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print('No baseline at {}; run with --save-baseline first'.format(args.baseline), file=sys.stderr)
+            return 2
+        except ValueError as e:
+            print('Cannot read the baseline at {}: {}'.format(args.baseline, e), file=sys.stderr)
+            return 2
+
+    if args.engine:
+        aes.set_engine(args.engine)
+    report = run_benchmarks(args.max_size, args.min_time, args.filter)
+
+    status = 0
+    if baseline is not None:
+        report['regressions'] = compare(report, baseline, args.tolerance)
+        if report['regressions']:
+            status = 1
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(text + '\n')
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,25 @@
 """
 VPN connector
+
+Every message is sent as one frame: a 4 byte big-endian length, then the message.
+The receiver reads the stream into a reusable buffer and splits it back into exactly
+the messages that were sent, however TCP chunked them.
+
+Messages received on a connection are either queued, for receive, receive_wait or
+iterating over the connector, or handed straight to subscribed callbacks. Both wake
+as soon as data arrives.
+
+Connector serves a single peer with a sender and a receiver thread. SessionServer keeps
+its listening socket open and serves any number of peers from one thread with a
+selector (epoll where available), each as a ServerSession with its own queues and key
+state.
 """
 
+import collections
 import time
+import selectors
 import socket
+import struct
 import queue
 import threading
 import logging
@@ -12,20 +28,135 @@ import logging
 HOST = ''
 PORT = 50002
 
-RECV_LENGTH = 1024
 RECV_ATTEMPTS = 16
 
+# Default size of the receive buffer. It grows in steps while a larger frame arrives,
+# and shrinks back once that frame has been handed on.
+RECV_BUFFER_SIZE = 65536
+
+# Largest message a frame may carry; a longer length prefix ends the connection
+MAX_FRAME_SIZE = 1 << 24
+
+# Length prefix of every frame
+frame_struct = struct.Struct('>I')
+
+# Seconds the receiver waits for data before checking whether it was closed
+RECV_TIMEOUT = 0.5
+
+# Seconds the sender blocks waiting for a message before checking whether it was closed
+SEND_TIMEOUT = 0.5
+# Seconds Connector.close waits for each thread, e.g. for the sender to flush its queue
+CLOSE_TIMEOUT = 1.0
+# Most queued messages the sender writes with a single call (well under IOV_MAX)
+SEND_BATCH_MESSAGES = 64
+
+# Pending connections the SessionServer listening socket queues
+SERVER_BACKLOG = 128
+
 class ConnectionDeadException(BaseException):
     pass
 
-class Connector(object):
+class Inbox(object):
+    """
+    Receive side shared by Connector and ServerSession: received messages are queued,
+    or handed to subscribed callbacks if there are any. Subclasses provide is_alive.
+    """
+    def __init__(self, receive_queue=None):
+        self.receive_queue = receive_queue
+        self.subscribers = []
+        self.deliver_lock = threading.Lock()
+
+    def _deliver(self, message):
+        """
+        Called by the receiving thread with every message: hands it to the subscribers,
+        or queues it if there are none. A callback that raises does not stop the others
+        or the receiving thread; see _callback_failed.
+        """
+        with self.deliver_lock:
+            if not self.subscribers:
+                self.receive_queue.put(message)
+                return
+            for callback in self.subscribers:
+                try:
+                    callback(message)
+                except (Exception, ConnectionDeadException):
+                    self._callback_failed(callback)
+
+    def _callback_failed(self, callback):
+        """Called from an except block when a subscriber callback raises; logs it."""
+        logging.getLogger().exception('Subscriber callback {!r} failed'.format(callback))
+
+    def subscribe(self, callback):
+        """
+        Calls callback(message) from the receiving thread for every message received
+        from now on, instead of queueing it. Messages already queued are handed over
+        first, so none are lost or reordered.
+        """
+        with self.deliver_lock:
+            self.subscribers.append(callback)
+            while self.receive_queue is not None and not self.receive_queue.empty():
+                try:
+                    callback(self.receive_queue.get_nowait())
+                except (Exception, ConnectionDeadException):
+                    self._callback_failed(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Stops calling callback; once there are no subscribers messages are queued again.
+        """
+        with self.deliver_lock:
+            self.subscribers.remove(callback)
+
+    def receive(self, timeout=0):
+        """
+        Recieve a message over the connection
+        Arguments:
+            timeout - seconds to wait for a message; 0 returns at once, None waits
+                      for as long as it takes
+        Returns:
+            string received if there is data in queue (or there is within timeout)
+            otherwise None
+        Raises:
+            ConnectionDeadException if connection has failed
+        """
+        # self.assert_alive() # could use decorator
+        try:
+            if timeout == 0:
+                message = self.receive_queue.get_nowait()
+            else:
+                message = self.receive_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        logging.getLogger().info('Receiving message')
+        return message
+
+    def receive_wait(self):
+        """
+        Waits until you receive something, then return it
+        """
+        return self.receive(timeout=None)
+
+    def __iter__(self):
+        """
+        Yields messages as they arrive, until the connection is closed and every
+        received message has been yielded.
+        """
+        while True:
+            message = self.receive(timeout=RECV_TIMEOUT)
+            if message is not None:
+                yield message
+            elif not self.is_alive():
+                return
+
+class Connector(Inbox):
     def __init__(self, server=False, host=HOST, port=PORT):
+        Inbox.__init__(self)
         self.host = host
         self.port = int(port)
         self.server = server
+        self.sock = None
         self.send_queue = None
         self.send_thread = None
-        self.receive_queue = None
         self.receive_thread = None
 
     def connect(self):
@@ -42,7 +173,8 @@ class Connector(object):
             else:
                 logging.getLogger().info('Client is connecting to server: ' + self.host)
                 _client_connect(sock, self.host, self.port)
-            self.receive_thread = Receiver(clientsocket, self.host, self.port, self.receive_queue)
+            self.sock = clientsocket
+            self.receive_thread = Receiver(clientsocket, self.host, self.port, self._deliver)
             self.send_thread = Sender(clientsocket, self.host, self.port, self.send_queue)
             self.receive_thread.daemon, self.send_thread.daemon = 1, 1
             self.send_thread.start()
@@ -55,34 +187,11 @@ class Connector(object):
             ConnectionDeadException if connection has failed
         """
         # self.assert_alive() # could use decorator
+        if len(message) > MAX_FRAME_SIZE:
+            raise ValueError('Messages are limited to {} bytes'.format(MAX_FRAME_SIZE))
         logging.getLogger().info('Adding message to queue')
         self.send_queue.put(message)
 
-    def receive(self):
-        """
-        Recieve a message over the connection
-        Returns:
-            string received if there is data in queue
-            otherwise None
-        Raises:
-            ConnectionDeadException if connection has failed
-        """
-        # self.assert_alive() # could use decorator
-        if not self.receive_queue.empty():
-            logging.getLogger().info('Receiving message')
-            return self.receive_queue.get()
-        else:
-            return None
-
-    def receive_wait(self):
-        """
-        Waits until you receive something, then return it
-        """
-        rcv = None
-        while rcv == None:
-            rcv = self.receive()
-        return rcv
-
     def assert_alive(self):
         if not self.is_alive():
             self.close()
@@ -96,13 +205,27 @@ class Connector(object):
             return False
 
     def close(self):
+        """
+        Stops both threads and closes the socket. Messages already queued are sent
+        first, for up to CLOSE_TIMEOUT seconds. This is the only place the socket of
+        the connection is closed.
+        """
         logging.getLogger().info('Closing connection thread')
-        if self.receive_thread != None:
-            self.receive_thread.close()
-        if self.send_thread != None:
-            self.send_thread.close()
+        send_thread, receive_thread, sock = self.send_thread, self.receive_thread, self.sock
         self.send_thread = None
         self.receive_thread = None
+        self.sock = None
+        if send_thread != None:
+            send_thread.close()
+            _join(send_thread)
+        if receive_thread != None:
+            receive_thread.close()
+        if sock is not None:
+            # Wakes the receiver and fails any write still blocked on the socket
+            _shutdown(sock)
+            _join(receive_thread)
+            _join(send_thread)
+            sock.close()
 
     def __del__(self):
         self.close()
@@ -113,6 +236,18 @@ def _get_socket():
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     return sock
 
+def _shutdown(sock):
+    """Shuts down both directions of sock, ignoring a socket that is already dead."""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def _join(thread):
+    """Waits up to CLOSE_TIMEOUT seconds for thread, unless it is the calling thread."""
+    if thread is not None and thread is not threading.current_thread():
+        thread.join(CLOSE_TIMEOUT)
+
 def get_ip():
     ip = socket.gethostbyname(socket.gethostname())
     return ip
@@ -144,11 +279,97 @@ def _client_connect(sock, host, port):
             print('Attempted to connect to host {} and port {}'.format(host, port))
             raise
 
+class FrameReader(object):
+    """
+    Splits a byte stream into length-prefixed frames. Data is read with recv_into
+    straight into one preallocated buffer that is reused for every read, and a frame is
+    only copied out once it is complete.
+
+    The buffer grows with the bytes that have actually arrived, never straight to the
+    length a frame announces, so an unauthenticated peer cannot make it allocate more
+    than about twice what it has sent.
+    """
+    def __init__(self, size=RECV_BUFFER_SIZE):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def recv_from(self, sock):
+        """
+        Reads whatever sock has ready into the buffer.
+        Returns:
+            the number of bytes read, 0 if the peer closed the connection
+        """
+        count = sock.recv_into(self.get_buffer())
+        self.buffer_updated(count)
+        return count
+
+    def get_buffer(self):
+        """
+        Returns a writable memoryview of the free end of the buffer, making room first
+        if it is full. Pass the number of bytes written to it to buffer_updated.
+        """
+        if self.end == len(self.buffer):
+            self._make_room()
+        return self.view[self.end:]
+
+    def buffer_updated(self, count):
+        self.end += count
+
+    def _make_room(self):
+        """
+        Moves the incomplete frame at the end of the buffer to its start. If the frame
+        would not fit, the buffer grows by at most its size plus the default size, up to
+        what the frame needs.
+        """
+        pending = self.end - self.start
+        needed = frame_struct.size
+        if pending >= frame_struct.size:
+            needed += frame_struct.unpack_from(self.buffer, self.start)[0]
+        size = len(self.buffer)
+        if needed > size:
+            size = min(needed, max(2 * size, pending + self.size))
+        self._move_pending(size)
+
+    def _move_pending(self, size):
+        """Moves the bytes from start to end to the start of a buffer of size bytes."""
+        pending = self.end - self.start
+        if size != len(self.buffer):
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer, self.view = buffer, memoryview(buffer)
+        else:
+            self.buffer[:pending] = bytes(self.view[self.start:self.end])
+        self.start, self.end = 0, pending
+
+    def frames(self):
+        """
+        Yields every complete frame in the buffer as bytes.
+        Raises:
+            ValueError if a frame is longer than MAX_FRAME_SIZE
+        """
+        while self.end - self.start >= frame_struct.size:
+            length, = frame_struct.unpack_from(self.buffer, self.start)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError('Frame of {} bytes is too long'.format(length))
+            body = self.start + frame_struct.size
+            if self.end - body < length:
+                break
+            self.start = body + length
+            yield bytes(self.view[body:self.start])
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buffer) > self.size and self.end - self.start < self.size:
+            # A large frame has been handed on; give its memory back
+            self._move_pending(self.size)
+
 class Receiver(threading.Thread):
     """
-    Server class, receives messages on a socket and puts them in a queue
+    Server class, receives framed messages on a socket and passes each one to deliver
     """
-    def __init__(self, sock, host, port, message_queue):
+    def __init__(self, sock, host, port, deliver):
         threading.Thread.__init__(self)
         if sock is None:
             self.sock = _get_socket()
@@ -156,34 +377,48 @@ class Receiver(threading.Thread):
             self.sock = sock
         self.host = host
         self.port = port
-        self.message_queue = message_queue
+        self.deliver = deliver
+        self.reader = FrameReader()
         self.failed_connections = 0
         self.cont = True
 
     def log_received(self, message):
         logger = logging.getLogger()
-        to_log = "Received: {}".format(bytestring_as_hex_string(message))
-        logger.info(to_log)
+        if logger.isEnabledFor(logging.INFO):
+            to_log = "Received: {}".format(bytestring_as_hex_string(message))
+            logger.info(to_log)
 
     def run(self):
-        while self.cont:
-            message = None
-            try:
-                message = self.sock.recv(RECV_LENGTH)
-            except ConnectionError:
-                break
-            if message:
-                self.message_queue.put(message)
-                self.log_received(message)
-            self.failed_connections = 0
-        self.sock.close()
+        # Wait in a selector rather than with a socket timeout, which would also apply
+        # to the sender's writes on the same socket
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(self.sock, selectors.EVENT_READ)
+            while self.cont:
+                if not selector.select(RECV_TIMEOUT):
+                    continue
+                if not self.reader.recv_from(self.sock):
+                    # The peer closed the connection
+                    break
+                for message in self.reader.frames():
+                    self.deliver(message)
+                    self.log_received(message)
+                self.failed_connections = 0
+        except (OSError, ValueError):
+            pass
+        finally:
+            selector.close()
+        # Tell the sender and the peer the connection is over; Connector.close
+        # closes the socket
+        _shutdown(self.sock)
 
     def close(self):
         self.cont = False
 
 class Sender(threading.Thread):
     """
-    Sender class, sends messages from a queue as they are inserted
+    Sender class, sends messages from a queue as they are inserted. It blocks on the
+    queue while idle, and writes everything queued by then with one vectored call.
     """
     def __init__(self, sock, host, port, send_queue):
         threading.Thread.__init__(self)
@@ -198,21 +433,289 @@ class Sender(threading.Thread):
 
     def log_sent(self, message):
         logger = logging.getLogger()
-        to_log = "Sent: {}".format(bytestring_as_hex_string(message))
-        logger.info(to_log)
+        # Formatting the hex dump costs far more than sending, skip it when unused
+        if logger.isEnabledFor(logging.INFO):
+            to_log = "Sent: {}".format(bytestring_as_hex_string(message))
+            logger.info(to_log)
 
     def run(self):
         while self.cont:
-            if not self.send_queue.empty():
-                message = self.send_queue.get()
+            try:
+                message = self.send_queue.get(timeout=SEND_TIMEOUT)
+            except queue.Empty:
+                continue
+            if message is None:
+                # Queued by close, after every message still to be sent
+                break
+            batch = [message]
+            while len(batch) < SEND_BATCH_MESSAGES:
                 try:
-                    self.sock.send(message)
-                except ConnectionError:
+                    message = self.send_queue.get_nowait()
+                except queue.Empty:
                     break
+                if message is None:
+                    self.cont = False
+                    break
+                batch.append(message)
+            try:
+                self.send_all(batch)
+            except OSError:
+                # The peer or the receiver shut the socket down; Connector.close
+                # closes it
+                break
+            for message in batch:
                 self.log_sent(message)
-        self.sock.close()
+
+    def send_all(self, messages):
+        """
+        Writes every message in order as a frame, with a single sendmsg call when the
+        socket takes them all, and picks up where a partial write stopped otherwise.
+        """
+        buffers = []
+        for message in messages:
+            message = memoryview(message).cast('B')
+            buffers += [memoryview(frame_struct.pack(len(message))), message]
+        if not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(b''.join(buffers))
+            return
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if buffers and sent:
+                buffers[0] = buffers[0][sent:]
+
+    def close(self):
+        """Stops the thread once every message queued so far has been sent."""
+        self.send_queue.put(None)
+
+class ServerSession(Inbox):
+    """
+    One client of a SessionServer. It has the receive API of a Connector; send queues
+    a message for the server thread to write. The keys attribute is free for the
+    application to hold the session's key state (e.g. a kdf.SessionKeys).
+    """
+    def __init__(self, server, sock, addr):
+        Inbox.__init__(self, queue.Queue())
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.keys = None
+        self.reader = FrameReader()
+        # memoryviews still to be written, prefixes and messages alternating
+        self.outgoing = collections.deque()
+        self.outgoing_lock = threading.Lock()
+        self.alive = True
+
+    def send(self, message):
+        """
+        Send a message to the client
+        Raises:
+            ConnectionDeadException if the session is closed
+        """
+        message = memoryview(message).cast('B')
+        if len(message) > MAX_FRAME_SIZE:
+            raise ValueError('Messages are limited to {} bytes'.format(MAX_FRAME_SIZE))
+        if not self.alive:
+            raise ConnectionDeadException('Lost connection')
+        with self.outgoing_lock:
+            self.outgoing.append(memoryview(frame_struct.pack(len(message))))
+            self.outgoing.append(message)
+        self.server._request(self)
+
+    def _read(self):
+        """
+        Called by the server thread when the socket is readable.
+        Returns:
+            False if the session has ended
+        """
+        try:
+            if not self.reader.recv_from(self.sock):
+                return False
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        frames = self.reader.frames()
+        while self.alive:
+            try:
+                message = next(frames, None)
+            except ValueError:
+                # Only a malformed frame from the client is a protocol error
+                logging.getLogger().info('Dropping session {}: frame too long'.format(self.addr[0]))
+                return False
+            if message is None:
+                return True
+            self._deliver(message)
+        # A subscriber callback failed or closed the session
+        return False
+
+    def _callback_failed(self, callback):
+        """Logs the failure and ends this session only."""
+        Inbox._callback_failed(self, callback)
+        self.close()
+
+    def _write(self):
+        """
+        Called by the server thread when the socket is writable. Writes as much of the
+        outgoing data as the socket takes with one sendmsg call.
+        Returns:
+            whether data is still waiting to be written
+        """
+        with self.outgoing_lock:
+            if not self.outgoing:
+                return False
+            buffers = [self.outgoing[i] for i in range(min(len(self.outgoing), 2 * SEND_BATCH_MESSAGES))]
+            try:
+                sent = self.sock.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                return True
+            except OSError:
+                # The client is gone; the server ends the session
+                self.alive = False
+                self.outgoing.clear()
+                return False
+            while self.outgoing and sent >= len(self.outgoing[0]):
+                sent -= len(self.outgoing.popleft())
+            if self.outgoing and sent:
+                self.outgoing[0] = self.outgoing[0][sent:]
+            return bool(self.outgoing)
+
+    def is_alive(self):
+        return self.alive
+
+    def close(self):
+        """Ends the session; the server thread closes the socket."""
+        self.alive = False
+        self.server._request(self)
+
+class SessionServer(threading.Thread):
+    """
+    Multi-session server. The listening socket stays open, and every accepted client
+    is served from this one thread: a selector waits on all the sockets at once and
+    reads or writes whichever are ready, so hundreds of sessions need no extra threads.
+
+    on_session(session) is called from the server thread for every new ServerSession
+    and must not block; hand longer work (such as the handshake) to another thread or
+    subscribe to the session's messages. If on_session or a subscriber callback
+    raises, the error is logged and only that session is closed.
+    """
+    def __init__(self, host=HOST, port=PORT, on_session=None, backlog=SERVER_BACKLOG):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.port = int(port)
+        self.on_session = on_session
+        self.backlog = backlog
+        self.sessions = {}
+        self.cont = True
+        self.selector = selectors.DefaultSelector()
+        self.listener = _get_socket()
+        # Writing a byte here wakes the selector when another thread needs it
+        self.wakeup, self.wakeup_sender = socket.socketpair()
+        self.requests = set()
+        self.requests_lock = threading.Lock()
+
+    def start(self):
+        """
+        Binds and listens before starting the server thread, so clients may connect as
+        soon as this returns.
+        """
+        logging.getLogger().info('Binding socket to server IP: ' + (self.host or '*'))
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(self.backlog)
+        self.listener.setblocking(False)
+        self.wakeup.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self.listener)
+        self.selector.register(self.wakeup, selectors.EVENT_READ, self.wakeup)
+        threading.Thread.start(self)
+
+    def _request(self, session):
+        """
+        Asks the server thread to look at session again, because it has data to write
+        or was closed.
+        """
+        with self.requests_lock:
+            first = not self.requests
+            self.requests.add(session)
+        if first:
+            try:
+                self.wakeup_sender.send(b'\0')
+            except OSError:
+                pass
+
+    def _accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        session = ServerSession(self, sock, addr)
+        self.sessions[sock.fileno()] = session
+        self.selector.register(sock, selectors.EVENT_READ, session)
+        logging.getLogger().info('Server is connected to client: ' + str(addr[0]))
+        if self.on_session is not None:
+            try:
+                self.on_session(session)
+            except (Exception, ConnectionDeadException):
+                # Only this session suffers for a failing handler
+                logging.getLogger().exception('on_session failed for ' + str(addr[0]))
+                self._end(session)
+
+    def _handle_requests(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self.requests_lock:
+            requests, self.requests = self.requests, set()
+        for session in requests:
+            if not session.alive:
+                self._end(session)
+            elif session.sock.fileno() in self.sessions:
+                self._write(session)
+
+    def _write(self, session):
+        """Writes what session can take, and watches for writability while more is left."""
+        writing = session._write()
+        if not session.alive:
+            self._end(session)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+        self.selector.modify(session.sock, events, session)
+
+    def _end(self, session):
+        session.alive = False
+        if self.sessions.pop(session.sock.fileno(), None) is not None:
+            self.selector.unregister(session.sock)
+            session.sock.close()
+            logging.getLogger().info('Session closed: ' + str(session.addr[0]))
+
+    def run(self):
+        while self.cont:
+            for key, mask in self.selector.select(RECV_TIMEOUT):
+                if key.data is self.listener:
+                    self._accept()
+                elif key.data is self.wakeup:
+                    self._handle_requests()
+                else:
+                    session = key.data
+                    if mask & selectors.EVENT_READ and not session._read():
+                        self._end(session)
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._write(session)
+        for session in list(self.sessions.values()):
+            self._end(session)
+        self.selector.close()
+        self.listener.close()
+        self.wakeup.close()
+        self.wakeup_sender.close()
 
     def close(self):
+        """Stops accepting and ends every session."""
         self.cont = False
 
 def bytestring_as_hex_string(message):
@@ -7,8 +7,23 @@ def gen_public_transport(encrypt_protocol=False, long_term_key=0)
 gen_session_key(inc_pub_transport, local_exponent, encrypt_protocol=False, long_term_key=0)
 -- used with the incoming transport data to generate a session key, only known
         locally, and to the computer that sent the transport data
+gen_key_pair()
+-- used to generate a single-use (local_exponent, public value) pair
+encode_public_transport(auth_arr, public_value), decode_public_transport(dat)
+-- the fixed-width, length-prefixed codec for the public transport
+
+Classes:
+KeyPool -- reserve of key pairs precomputed by background threads
+FixedBasePow -- exponentiation of a fixed base from a precomputed window table
 """
+import hmac
+import logging
+import queue
 import random
+import secrets
+import struct
+import threading
+import time
 import aes
 import connector
 
@@ -24,8 +39,194 @@ prime = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBE
 #associated generator number - http://www.ietf.org/rfc/rfc3526.txt
 gen = 2
 
+# Public values and shared secrets are always sent as this many big-endian bytes (192)
+PUBLIC_VALUE_SIZE = (prime.bit_length() + 7) // 8
 
-def gen_public_transport(long_term_key, auth_arr):
+# 4 byte ID followed by a 16 byte nonce
+AUTH_MSG_SIZE = 20
+
+# Public transport codec: version, message type and body length precede the body, so
+# the receiver knows exactly where the body ends whatever the AES padding looks like
+CODEC_VERSION = 1
+MSG_PUBLIC_TRANSPORT = 1
+codec_header_struct = struct.Struct('>BBH')
+
+# Number of precomputed key pairs the shared KeyPool keeps in reserve
+KEY_POOL_SIZE = 8
+
+# Exponent bits consumed per table lookup by FixedBasePow. Each window costs a row of
+# 2^FIXED_BASE_WINDOW residues; 6 bits keeps the table for a 128-bit exponent near 270 KB.
+FIXED_BASE_WINDOW = 6
+
+# Exponents longer than this always use the builtin pow, bounding the table size
+FIXED_BASE_MAX_BITS = 512
+
+# Exponents timed per path when FixedBasePow picks the faster one for a size
+FIXED_BASE_BENCH_RUNS = 8
+
+class FixedBasePow(object):
+    """
+    Computes base^exponent mod modulus for a fixed base with a precomputed window
+    table: row i holds base^(d * 2^(window * i)) for every window digit d, so an
+    exponent costs one modular multiplication per non-zero window and no squarings.
+    Rows are built lazily as longer exponents are seen.
+
+    The first exponent of each size is timed against the builtin pow and the faster
+    path is remembered for that size.
+    """
+    def __init__(self, base, modulus, window=FIXED_BASE_WINDOW, max_bits=FIXED_BASE_MAX_BITS):
+        self.base = base
+        self.modulus = modulus
+        self.window = window
+        self.max_bits = max_bits
+        self.rows = []
+        self.row_base = base % modulus
+        # number of windows -> whether the table beat the builtin pow
+        self.faster = {}
+        self.lock = threading.Lock()
+
+    def _extend(self, nrows):
+        with self.lock:
+            while len(self.rows) < nrows:
+                row = [1]
+                for _ in range((1 << self.window) - 1):
+                    row.append(row[-1] * self.row_base % self.modulus)
+                self.row_base = row[-1] * self.row_base % self.modulus
+                self.rows.append(row)
+
+    def table_pow(self, exponent):
+        """
+        Returns base^exponent mod modulus, computed from the table.
+        """
+        nrows = -(-exponent.bit_length() // self.window)
+        if len(self.rows) < nrows:
+            self._extend(nrows)
+        rows, mask, modulus = self.rows, (1 << self.window) - 1, self.modulus
+        result, i = 1, 0
+        while exponent:
+            digit = exponent & mask
+            if digit:
+                result = result * rows[i][digit] % modulus
+            exponent >>= self.window
+            i += 1
+        return result
+
+    def benchmark(self, bits, runs=FIXED_BASE_BENCH_RUNS):
+        """
+        Times both paths on the same random exponents of the given bit length.
+
+        Returns: tuple(builtin pow seconds, table seconds), per exponent
+        """
+        exponents = [random.getrandbits(bits) | 1 << (bits - 1) for _ in range(runs)]
+        self.table_pow(exponents[0])  # build the rows outside the timing
+        start = time.perf_counter()
+        for exponent in exponents:
+            pow(self.base, exponent, self.modulus)
+        builtin = (time.perf_counter() - start) / runs
+        start = time.perf_counter()
+        for exponent in exponents:
+            self.table_pow(exponent)
+        table = (time.perf_counter() - start) / runs
+        return builtin, table
+
+    def __call__(self, exponent):
+        """
+        Returns base^exponent mod modulus, by whichever path is faster for its size.
+        """
+        bits = exponent.bit_length()
+        if exponent < 0 or bits > self.max_bits:
+            return pow(self.base, exponent, self.modulus)
+        nrows = -(-bits // self.window)
+        faster = self.faster.get(nrows)
+        if faster is None:
+            builtin, table = self.benchmark(max(nrows * self.window, 1))
+            faster = self.faster[nrows] = table < builtin
+        if faster:
+            return self.table_pow(exponent)
+        return pow(self.base, exponent, self.modulus)
+
+# gen^exponent mod prime, from a table built on first use
+gen_pow = FixedBasePow(gen, prime)
+
+_key_pool = None
+_key_pool_lock = threading.Lock()
+
+def gen_key_pair():
+    """
+    generates a single-use Diffie-Hellman key pair.
+
+    Returns: tuple(local_exponent, public value as an int)
+    """
+    local_exponent = secrets.randbits(128)
+    return local_exponent, gen_pow(local_exponent)
+
+class KeyPool(object):
+    """
+    Keeps a bounded reserve of precomputed key pairs so a handshake does not have to
+    wait for the modular exponentiation. Daemon threads refill the reserve whenever a
+    pair is taken; get hands a pair out in O(1), and only computes one inline if the
+    reserve has run dry. Every pair is handed out once.
+    """
+    def __init__(self, size=KEY_POOL_SIZE, workers=1):
+        self.pairs = queue.Queue(maxsize=size)
+        self.running = True
+        self.threads = [threading.Thread(target=self._refill, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _refill(self):
+        while self.running:
+            pair = gen_key_pair()
+            while self.running:
+                try:
+                    # Blocks while the reserve is full; the timeout lets stop() end the thread
+                    self.pairs.put(pair, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """
+        Returns: tuple(local_exponent, public value as an int), never returned before
+        """
+        try:
+            return self.pairs.get_nowait()
+        except queue.Empty:
+            return gen_key_pair()
+
+    def available(self):
+        """Returns the number of pairs currently in reserve."""
+        return self.pairs.qsize()
+
+    def stop(self):
+        """Stops the refill threads. Pairs already in reserve are discarded."""
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        while not self.pairs.empty():
+            self.pairs.get_nowait()
+
+def get_key_pool():
+    """
+    Returns the shared KeyPool, starting it on first use. Call early (e.g. at
+    application start-up) so the reserve is filled before the first handshake.
+    """
+    global _key_pool
+    with _key_pool_lock:
+        if _key_pool is None:
+            _key_pool = KeyPool()
+        return _key_pool
+
+def stop_key_pool():
+    """Stops the shared KeyPool, if it was started."""
+    global _key_pool
+    with _key_pool_lock:
+        if _key_pool is not None:
+            _key_pool.stop()
+            _key_pool = None
+
+
+def gen_public_transport(long_term_key, auth_arr, key_pair=None):
     """
     generates a tuple containing the data to pass to the other computer,
     aka the public_transport, as well as the local-exponent which will
@@ -36,35 +237,28 @@ def gen_public_transport(long_term_key, auth_arr):
     auth_arr - if present, is used as per the authentication DH scheme
                that is, it's prepended to the proper public_transport
                before encryption.
+    key_pair - (local_exponent, public value) from gen_key_pair to use; taken
+               from the shared key pool if None
 
     Returns: tuple(public_transport, local_exponent)
     """
     if debug:
         print("generating public transport data")
 
-    local_exponent, pub_transport, pub_transport_arr = None, None, None
-    while True:
-        local_exponent = random.getrandbits(128)
-        if debug:
-            print("local_exponent: " + str(local_exponent))
-
-        pub_transport = pow(gen, local_exponent, prime)
-        if debug:
-            print("pub_transport:" + str(pub_transport))
-
-        # -pub_transport is an array of bytes, if encrypted
-        # -Encrypt the public_transport
-        # with the authorization_array (the ID and nonce) prepended to
-        # the transport data
-        pub_transport_arr = int_to_byte_array(pub_transport)
-        if pub_transport_arr[-1] != 128:
-            # We are okay as long as the last byte is not the same as the padding byte
-            # for AES. Otherwise it will be stripped. If it is 128, continue generating
-            # local exponents until it is not.
-            break;
-
-    pub_transport = list(auth_arr) + list(pub_transport_arr)
-    print("generating public transport - public transport: " + str(pub_transport))
+    # The key pair comes precomputed from the shared pool, so the handshake does
+    # not wait on the exponentiation
+    if key_pair is None:
+        key_pair = get_key_pool().get()
+    local_exponent, public_value = key_pair
+    if debug:
+        print("local_exponent: " + str(local_exponent))
+        print("pub_transport:" + str(public_value))
+
+    # -pub_transport is an array of bytes, if encrypted
+    # -Encrypt the public_transport
+    # with the authorization_array (the ID and nonce) prepended to
+    # the transport data
+    pub_transport = encode_public_transport(auth_arr, public_value)
     pub_transport = aes.aes_encrypt(pub_transport, long_term_key)
     if debug:
         print("public_transport, encrypted: " + str(pub_transport))
@@ -85,26 +279,29 @@ def gen_session_key(inc_pub_transport, local_exponent, long_term_key, auth_arr):
                      as comparison with the received array to authenticate.
 
     returns:
-    unique session key (only known to client/server), or 0 if using auth_arr,
-    and data not authenticated
+    unique shared secret (only known to client/server) as a bytearray, or 0 if using
+    auth_arr, and data not authenticated. Derive the session keys from it with kdf.
     """
-    inc_pub_transport_bytes = aes.aes_decrypt(inc_pub_transport, long_term_key)
-    print("generating session key - public transport: " + str(inc_pub_transport_bytes))
-    inc_auth_arr = inc_pub_transport_bytes[:20]
-    for inc_byte,auth_byte in zip(inc_auth_arr, auth_arr):
-        if not inc_byte == auth_byte:
-            print("Not authenticated.")
-            return 0
-
-    # reduce bytes to actual data
-    inc_pub_transport_bytes = inc_pub_transport_bytes[20:]
-
-    inc_pub_transport = byte_array_to_int(inc_pub_transport_bytes)
+    inc_pub_transport = aes.as_bytes(inc_pub_transport)
+    if len(inc_pub_transport) < 32 or len(inc_pub_transport) % 16:
+        logging.getLogger().info('Not authenticated')
+        return 0
+    # The codec header gives the body length, so the padding is never looked at
+    inc_pub_transport_bytes = bytearray(len(inc_pub_transport) - 16)
+    aes.aes_decrypt_into(inc_pub_transport, long_term_key, inc_pub_transport_bytes)
+    try:
+        inc_auth_arr, inc_pub_transport = decode_public_transport(inc_pub_transport_bytes)
+    except ValueError:
+        logging.getLogger().info('Not authenticated')
+        return 0
+    if not hmac.compare_digest(inc_auth_arr, bytes(auth_arr)):
+        logging.getLogger().info('Not authenticated')
+        return 0
 
     session_key = pow(inc_pub_transport, local_exponent, prime)
 
-    # get first 16 bytes, so that key corresponds to a true aes key.
-    session_key = int_to_byte_array(session_key)[:16]
+    # the whole shared secret at fixed width; kdf derives the actual aes and mac keys from it
+    session_key = bytearray(session_key.to_bytes(PUBLIC_VALUE_SIZE, 'big'))
 
     if debug:
         print("private session key is: " + str(session_key))
@@ -113,15 +310,47 @@ def gen_session_key(inc_pub_transport, local_exponent, long_term_key, auth_arr):
 
 def gen_nonce():
     """
-    generates a nonce and prevents the last byte from being the padding bit used in
-    the aes encryption (128)
+    generates a nonce
 
     Returns: 16 byte nonce represented in byte array.
     """
-    nonce = list(int_to_byte_array(random.getrandbits(128), 16))
-    while nonce[-1] == 128:
-        nonce[-1] = random.getrandbits(8)
-    return nonce
+    return list(secrets.token_bytes(16))
+
+def encode_public_transport(auth_arr, public_value):
+    """
+    encodes the authentication message and public value of the public transport in
+    one shot: a header (version, type, body length), the 20 byte ID and nonce, then
+    the public value as exactly PUBLIC_VALUE_SIZE big-endian bytes.
+
+    Returns: the encoded message as bytes
+    """
+    auth = bytes(auth_arr)
+    if len(auth) != AUTH_MSG_SIZE:
+        raise ValueError('The authentication message must be {} bytes'.format(AUTH_MSG_SIZE))
+    header = codec_header_struct.pack(CODEC_VERSION, MSG_PUBLIC_TRANSPORT, AUTH_MSG_SIZE + PUBLIC_VALUE_SIZE)
+    return header + auth + public_value.to_bytes(PUBLIC_VALUE_SIZE, 'big')
+
+def decode_public_transport(dat):
+    """
+    decodes a message made by encode_public_transport. Bytes after the body (such as
+    AES padding) are ignored.
+
+    Raises: ValueError if the header, length or public value is not valid
+    Returns: tuple(20 byte authentication message as bytes, public value as an int)
+    """
+    dat = memoryview(dat).cast('B')
+    if len(dat) < codec_header_struct.size:
+        raise ValueError('Truncated public transport')
+    version, msg_type, length = codec_header_struct.unpack_from(dat)
+    if version != CODEC_VERSION or msg_type != MSG_PUBLIC_TRANSPORT:
+        raise ValueError('Unknown public transport version or type')
+    body = dat[codec_header_struct.size:codec_header_struct.size + length]
+    if length != AUTH_MSG_SIZE + PUBLIC_VALUE_SIZE or len(body) != length:
+        raise ValueError('Public transport has the wrong length')
+    public_value = int.from_bytes(body[AUTH_MSG_SIZE:], 'big')
+    if not 1 < public_value < prime - 1:
+        raise ValueError('Public value out of range')
+    return bytes(body[:AUTH_MSG_SIZE]), public_value
 
 def gen_auth_msg(nonce_array=[]):
     """
@@ -130,8 +359,7 @@ def gen_auth_msg(nonce_array=[]):
 
     Arguments:
     Optionally supply a nonce_array, which if supplied will be
-    used in the returned array, rather than generating a new one. If you
-    supply a nonce, the last byte cannot be the padding character in aes, 128.
+    used in the returned array, rather than generating a new one.
     Basically use this parameter to append the ID to the nonce.
 
     Returns: 20 bytes starting with 4: id of self - IP,
@@ -152,24 +380,12 @@ def int_to_byte_array(input_int, forced_len=-1):
     forced_len - specify length of array, buffered with 0s by default
 
     Returns:
-    bytearray representative of inputInt
+    bytearray representative of inputInt (its low forced_len bytes, if given)
     """
-    int_bytes = bytearray()
-    idx = 0
-    while input_int > 0:
-        int_bytes.append(input_int % 256)
-        input_int = input_int // 256
-        idx += 1
-        if forced_len > 0:
-            if len(int_bytes) >= forced_len:
-                break
-
-    if forced_len > 0 and len(int_bytes) < forced_len:
-        while len(int_bytes) < forced_len:
-            int_bytes.append(0)
-
-    int_bytes.reverse()
-    return int_bytes
+    if forced_len > 0:
+        input_int &= (1 << (8 * forced_len)) - 1
+        return bytearray(input_int.to_bytes(forced_len, 'big'))
+    return bytearray(input_int.to_bytes((input_int.bit_length() + 7) // 8, 'big'))
 
 
 def byte_array_to_int(int_bytes):
@@ -182,13 +398,7 @@ def byte_array_to_int(int_bytes):
     Returns:
     arbitrarily long int
     """
-    ret_int = 0
-    place = 1
-    while(len(int_bytes) > 0):
-        ret_int += int_bytes.pop() * place
-        place *= 256
-
-    return ret_int
+    return int.from_bytes(bytes(int_bytes), 'big')
 
 def run_test():
     #Jorden Testing:
@@ -0,0 +1,71 @@
+"""
+Handshake engine module
+
+Runs the CPU heavy step of the authenticated Diffie-Hellman exchange in dh_auth (the
+1536-bit modular exponentiation of gen_session_key and the AES work around it) in a
+pool of worker processes, one per core. Public values come from the dh_auth key pool.
+The GIL no longer serializes the handshakes a server runs for many clients. Every
+call returns a concurrent.futures.Future right away, so a caller can start many
+handshakes and collect them as they finish. asyncio code can await the futures
+through asyncio.wrap_future.
+
+Classes:
+
+HandshakeEngine -- Process pool running handshake steps.
+
+Functions:
+
+get_handshake_engine -- Returns the shared engine, starting it on first use.
+shutdown_handshake_engine -- Stops the shared engine.
+"""
+
+import concurrent.futures
+import os
+import threading
+
+import dh_auth
+
+def session_key_task(inc_pub_transport, local_exponent, long_term_key, auth_arr):
+    """Worker: returns dh_auth.gen_session_key."""
+    return dh_auth.gen_session_key(inc_pub_transport, local_exponent, long_term_key, auth_arr)
+
+class HandshakeEngine(object):
+    """
+    Process pool for handshake steps. The arguments and results of each step are the
+    same as those of the dh_auth function it runs, wrapped in a Future.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+
+    def session_key(self, inc_pub_transport, local_exponent, long_term_key, auth_arr):
+        """
+        Returns a Future of dh_auth.gen_session_key(inc_pub_transport, local_exponent,
+        long_term_key, auth_arr).
+        """
+        return self.executor.submit(session_key_task, inc_pub_transport, local_exponent,
+                                    long_term_key, auth_arr)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+_handshake_engine = None
+_handshake_engine_lock = threading.Lock()
+
+def get_handshake_engine():
+    """
+    Returns the shared HandshakeEngine, starting it (one process per core) on first use.
+    """
+    global _handshake_engine
+    with _handshake_engine_lock:
+        if _handshake_engine is None:
+            _handshake_engine = HandshakeEngine()
+        return _handshake_engine
+
+def shutdown_handshake_engine():
+    """Shuts down the shared HandshakeEngine, if it was started."""
+    global _handshake_engine
+    with _handshake_engine_lock:
+        if _handshake_engine is not None:
+            _handshake_engine.shutdown()
+            _handshake_engine = None
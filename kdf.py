@@ -0,0 +1,248 @@
+"""
+Key derivation module
+
+Implements HKDF-SHA256 (RFC 5869) and the session key state built on it. The
+Diffie-Hellman shared secret is extracted into a pseudorandom key. Independent
+chain keys are then expanded from it for each direction, and each chain key gives
+that direction's AES encryption and CMAC keys.
+
+Rekeying is in-band and costs one hash: a direction ratchets its chain key forward
+(chain_key = HKDF-Expand(chain_key, "ratchet")) after a set number of messages or
+bytes, forgetting the old keys. Every frame carries the epoch (ratchet count) it was
+sealed under, so the receiver can follow without any extra messages.
+
+Nonces are never drawn at random. Every frame also carries its sequence number within
+the epoch, and the nonce is built from (direction, epoch, sequence number). The
+receiver refuses a sequence number that does not increase, so replayed frames are
+rejected.
+
+Classes:
+
+DirectionKeys -- The ratcheting keys for one direction of a session.
+SessionKeys -- Send and receive keys of a session, sealing and opening frames.
+
+Functions:
+
+hkdf_extract -- HKDF extract step.
+hkdf_expand -- HKDF expand step.
+hkdf -- Extract then expand.
+self_test -- Runs the RFC 5869 known-answer tests.
+"""
+
+import copy
+import hashlib
+import hmac
+import struct
+
+import aead
+import aes
+
+HASH_SIZE = 32
+KEY_SIZE = 16
+
+# A direction ratchets after this many messages or bytes, whichever comes first
+REKEY_MESSAGES = 1 << 16
+REKEY_BYTES = 1 << 26
+
+CLIENT_TO_SERVER = b'vpn client to server'
+SERVER_TO_CLIENT = b'vpn server to client'
+
+# Direction byte at the start of every nonce
+DIRECTION_CLIENT_TO_SERVER = 0
+DIRECTION_SERVER_TO_CLIENT = 1
+
+# Frame header: the epoch a frame was sealed under and its sequence number in that
+# epoch. The header is authenticated as associated data.
+header_struct = struct.Struct('>IQ')
+
+# A nonce is the direction byte, the epoch and the low SEQUENCE_BYTES of the sequence
+# number; a direction ratchets before its sequence numbers run out
+SEQUENCE_BYTES = aead.NONCE_SIZE - 5
+MAX_SEQUENCE = 1 << (8 * SEQUENCE_BYTES)
+nonce_struct = struct.Struct('>BI')
+
+# RFC 5869 appendix A test cases 1 and 3 (the latter with empty salt and info) as
+# (ikm, salt, info, prk, okm) in hex
+KNOWN_ANSWERS_HKDF = [('0b' * 22, '000102030405060708090a0b0c', 'f0f1f2f3f4f5f6f7f8f9',
+                       '077709362c2e32df0ddc3f0dc47bba6390b6c73bb50f9c3122ec844ad7c2b3e5',
+                       '3cb25f25faacd57a90434f64d0362f2a2d2d0a90cf1a5a4c5db02d56ecc4c5bf34007208d5b887185865'),
+                      ('0b' * 22, '', '',
+                       '19ef24a32c717b167f33a91d6f648bdf96596776afdb6377ac434c1c293ccb04',
+                       '8da4e775a563c18f715f802a063c5a31b8a11f5c5ee1879ec3454e5f3c738d2d9d201395faa4b61a96c8')]
+
+def hkdf_extract(salt, ikm):
+    """
+    Returns the 32 byte pseudorandom key for input keying material ikm.
+    """
+    return hmac.new(bytes(salt) or bytes(HASH_SIZE), bytes(ikm), hashlib.sha256).digest()
+
+def hkdf_expand(prk, info, length):
+    """
+    Returns length bytes of output keying material expanded from prk for context info.
+    """
+    if length > 255 * HASH_SIZE:
+        raise ValueError('Cannot expand more than {} bytes'.format(255 * HASH_SIZE))
+    okm, block = b'', b''
+    for counter in range(1, -(-length // HASH_SIZE) + 1):
+        block = hmac.new(prk, block + bytes(info) + bytes([counter]), hashlib.sha256).digest()
+        okm += block
+    return okm[:length]
+
+def hkdf(ikm, salt=b'', info=b'', length=KEY_SIZE):
+    """
+    Returns length bytes derived from ikm with HKDF-SHA256.
+    """
+    return hkdf_expand(hkdf_extract(salt, ikm), info, length)
+
+def self_test():
+    """
+    Runs the RFC 5869 known-answer tests against hkdf_extract and hkdf_expand.
+
+    Returns True if every answer matched.
+    """
+    for ikm, salt, info, prk, okm in KNOWN_ANSWERS_HKDF:
+        ikm, salt, info, prk, okm = [bytes.fromhex(x) for x in (ikm, salt, info, prk, okm)]
+        if hkdf_extract(salt, ikm) != prk or hkdf_expand(prk, info, len(okm)) != okm:
+            return False
+    return True
+
+class DirectionKeys(object):
+    """
+    Encryption and MAC keys for one direction, derived from a chain key that ratchets
+    forward one hash at a time.
+    """
+    def __init__(self, chain_key, direction, epoch=0):
+        self.direction = direction
+        self.epoch = epoch
+        self._set_chain_key(chain_key)
+
+    def _set_chain_key(self, chain_key):
+        self.chain_key = chain_key
+        keys = hkdf_expand(chain_key, b'keys', 2 * KEY_SIZE)
+        self.enc_key, self.mac_key = keys[:KEY_SIZE], keys[KEY_SIZE:]
+        self.messages = 0
+        self.bytes = 0
+
+    def forget(self):
+        """Drops the expanded round keys of the current keys from the schedule cache."""
+        aes.invalidate_key_schedule(self.enc_key)
+        aes.invalidate_key_schedule(self.mac_key)
+
+    def ratchet(self):
+        """
+        Moves to the next epoch. The previous keys cannot be recovered from the new ones.
+        """
+        self.forget()
+        self._set_chain_key(hkdf_expand(self.chain_key, b'ratchet', HASH_SIZE))
+        self.epoch += 1
+
+    def next_epoch(self):
+        """Returns a copy of these keys ratcheted forward one epoch."""
+        keys = copy.copy(self)
+        keys._set_chain_key(hkdf_expand(keys.chain_key, b'ratchet', HASH_SIZE))
+        keys.epoch += 1
+        return keys
+
+    def nonce(self, seq):
+        """Returns the nonce of the frame with sequence number seq in the current epoch."""
+        return nonce_struct.pack(self.direction, self.epoch) + seq.to_bytes(SEQUENCE_BYTES, 'big')
+
+    def count(self, nbytes):
+        self.messages += 1
+        self.bytes += nbytes
+
+    def accept(self, seq, nbytes):
+        """
+        Records an authentic received frame. On the receiving side messages is the
+        lowest sequence number still acceptable.
+        """
+        self.messages = seq + 1
+        self.bytes += nbytes
+
+    def needs_rekey(self, max_messages=REKEY_MESSAGES, max_bytes=REKEY_BYTES):
+        return self.messages >= min(max_messages, MAX_SEQUENCE) or self.bytes >= max_bytes
+
+class SessionKeys(object):
+    """
+    The keys of one end of a session: what it sends with and what it receives with.
+    Frames are epoch || seq || etm_seal(...), with the epoch and sequence number as
+    associated data.
+    """
+    def __init__(self, shared_secret, long_term_key, is_server,
+                 max_messages=REKEY_MESSAGES, max_bytes=REKEY_BYTES):
+        """
+        Arguments:
+        shared_secret -- The Diffie-Hellman shared secret (or a resumed session secret).
+        long_term_key -- Key derived from the shared password, used as the HKDF salt.
+        is_server -- Whether this end is the server; selects the direction of each key.
+        max_messages, max_bytes -- Ratchet the sending keys after this much traffic.
+        """
+        prk = hkdf_extract(long_term_key, shared_secret)
+        client_to_server = DirectionKeys(hkdf_expand(prk, CLIENT_TO_SERVER, HASH_SIZE),
+                                         DIRECTION_CLIENT_TO_SERVER)
+        server_to_client = DirectionKeys(hkdf_expand(prk, SERVER_TO_CLIENT, HASH_SIZE),
+                                         DIRECTION_SERVER_TO_CLIENT)
+        if is_server:
+            self.send, self.receive = server_to_client, client_to_server
+        else:
+            self.send, self.receive = client_to_server, server_to_client
+        # The receiving keys of the next epoch, derived when a frame first claims it, so
+        # forged frames claiming it cost no more hashing than the first one
+        self.next_receive = None
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+    def seal(self, plaintext):
+        """
+        Returns the frame carrying plaintext, ratcheting the sending keys first if they
+        are due.
+        """
+        if self.send.needs_rekey(self.max_messages, self.max_bytes):
+            self.send.ratchet()
+        seq = self.send.messages
+        header = header_struct.pack(self.send.epoch, seq)
+        sealed = aead.etm_seal(self.send.enc_key, self.send.mac_key, self.send.nonce(seq), plaintext, header)
+        self.send.count(len(plaintext))
+        return header + sealed
+
+    def open(self, frame):
+        """
+        Returns the plaintext of a frame as bytes, or None if it is not authentic or is
+        a replay (its sequence number is not above the last one accepted in its epoch).
+        The receiving keys only move to the next epoch once a frame of that epoch checks
+        out. Frames arrive in order and the sender never skips an epoch, so any other
+        epoch is refused without hashing.
+        """
+        frame = memoryview(frame).cast('B')
+        if len(frame) < header_struct.size + aead.TAG_SIZE:
+            return None
+        epoch, seq = header_struct.unpack_from(frame)
+        if epoch == self.receive.epoch:
+            keys = self.receive
+        elif epoch == self.receive.epoch + 1:
+            if self.next_receive is None:
+                self.next_receive = self.receive.next_epoch()
+            keys = self.next_receive
+        else:
+            return None
+        if seq < keys.messages or seq >= MAX_SEQUENCE:
+            return None
+        plaintext = aead.etm_open(keys.enc_key, keys.mac_key, keys.nonce(seq),
+                                  frame[header_struct.size:], frame[:header_struct.size])
+        if plaintext is None:
+            return None
+        if keys is not self.receive:
+            self.receive.forget()
+            self.receive, self.next_receive = keys, None
+        keys.accept(seq, len(plaintext))
+        return plaintext
+
+    def close(self):
+        """Drops the expanded round keys of both directions."""
+        self.send.forget()
+        self.receive.forget()
+        if self.next_receive is not None:
+            self.next_receive.forget()
+
+if __name__ == '__main__':
+    print('HKDF known answers: ' + ('ok' if self_test() else 'FAILED'))
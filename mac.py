@@ -2,16 +2,138 @@
 CBC-MAC module
 """
 
+import hmac
+
 import aes
 
 BLOCK_SIZE_BYTES = 16
 
+# Bytes handed to the cipher engine at a time by CbcMac.update; bounds the
+# ciphertext that is produced (and immediately dropped) per call.
+UPDATE_CHUNK_BYTES = 4096
+
+# Receives diagnostic messages from verify_macs when set; see set_debug_hook
+debug_hook = None
+
+# RFC 4493 section 4 AES-CMAC examples: the key, the 64 byte message, and the tag of
+# each prefix of it as (length, tag) in hex
+KNOWN_ANSWER_CMAC_KEY = '2b7e151628aed2a6abf7158809cf4f3c'
+KNOWN_ANSWER_CMAC_MESSAGE = ('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51'
+                             '30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710')
+KNOWN_ANSWERS_CMAC = [(0, 'bb1d6929e95937287fa37d129b756746'),
+                      (16, '070a16b46b4d4144f79bdd9dd04a287c'),
+                      (40, 'dfa66747de9ae63030ca32611497c827'),
+                      (64, '51f0bebf7e3b9d92fc49741779363cfe')]
+
+class CbcMac(object):
+    """
+    Incremental CBC-MAC. Only the chaining block and at most one partial block are
+    kept, so memory use does not grow with the message and large messages can be
+    authenticated as they stream in. The tag matches get_mac for the same input.
+    """
+    def __init__(self, mac_key, mac_iv=None):
+        self._start(aes.get_key_schedule(mac_key), mac_iv)
+
+    @classmethod
+    def from_schedule(cls, schedule, mac_iv=None):
+        """
+        Returns a CbcMac over an already expanded aes.KeySchedule, so a batch of
+        messages under one key does not look the key up again for each one.
+        """
+        cbc_mac = cls.__new__(cls)
+        cbc_mac._start(schedule, mac_iv)
+        return cbc_mac
+
+    def _start(self, schedule, mac_iv):
+        self.schedule = schedule
+        self.iv = aes.as_bytes(mac_iv) if mac_iv else aes.gen_iv()
+        if len(self.iv) != BLOCK_SIZE_BYTES:
+            raise TypeError('The key/iv must be 16 bytes')
+        self.chain = self.iv
+        self.pending = bytearray()
+
+    def update(self, dat):
+        """
+        Adds a chunk of the message (bytes-like, a list of bytes or a string).
+        """
+        if isinstance(dat, (str, list, tuple)):
+            dat = aes.as_bytes(dat)
+        dat = memoryview(dat).cast('B')
+        start = 0
+        if self.pending:
+            start = min(BLOCK_SIZE_BYTES - len(self.pending), len(dat))
+            self.pending += dat[:start]
+            if len(self.pending) < BLOCK_SIZE_BYTES:
+                return
+            self._absorb(self.pending)
+            self.pending = bytearray()
+        end = len(dat) - (len(dat) - start) % BLOCK_SIZE_BYTES
+        for i in range(start, end, UPDATE_CHUNK_BYTES):
+            self._absorb(dat[i:min(i + UPDATE_CHUNK_BYTES, end)])
+        self.pending += dat[end:]
+
+    def _absorb(self, blocks):
+        self.chain = aes.get_engine().cbc_encrypt(self.schedule, self.chain, blocks)[-BLOCK_SIZE_BYTES:]
+
+    def digest(self):
+        """
+        Returns the tag (the last CBC block, after 0x80 padding) as bytes. More data may
+        still be added afterwards.
+        """
+        if not self.pending:
+            return bytes(self.chain)
+        last = aes.pad_block(self.pending)
+        return aes.get_engine().cbc_encrypt(self.schedule, self.chain, last)
+
+    def verify(self, tag):
+        """
+        Returns whether tag matches the digest, using a constant-time comparison.
+        """
+        return hmac.compare_digest(self.digest(), aes.as_bytes(tag))
+
+def _cmac_double(block):
+    """Doubles a block in GF(2^128), as used to derive the CMAC subkeys."""
+    value = int.from_bytes(block, 'big') << 1
+    if value >> 128:
+        value = (value ^ 0x87) & ((1 << 128) - 1)
+    return value.to_bytes(BLOCK_SIZE_BYTES, 'big')
+
+def cmac(mac_key, dat):
+    """
+    Computes AES-CMAC (NIST SP 800-38B, RFC 4493) of dat. Unlike the plain CBC-MAC above,
+    CMAC is secure for messages of varying length.
+
+    Arguments:
+    mac_key -- 16 byte key (bytes, a list of bytes or a string).
+    dat -- Message as a bytes-like object.
+
+    Returns the 16 byte tag as bytes.
+    """
+    schedule = aes.get_key_schedule(mac_key)
+    engine = aes.get_engine()
+    dat = memoryview(dat).cast('B')
+    k1 = _cmac_double(engine.encrypt_blocks(schedule, bytes(BLOCK_SIZE_BYTES)))
+    if dat and len(dat) % BLOCK_SIZE_BYTES == 0:
+        split = len(dat) - BLOCK_SIZE_BYTES
+        last, subkey = bytes(dat[split:]), k1
+    else:
+        # Pad the short (or empty) last block with 0x80 then zeros
+        split = len(dat) - len(dat) % BLOCK_SIZE_BYTES
+        tail = bytes(dat[split:]) + b'\x80'
+        last, subkey = tail + bytes(BLOCK_SIZE_BYTES - len(tail)), _cmac_double(k1)
+    chain = bytes(BLOCK_SIZE_BYTES)
+    for i in range(0, split, UPDATE_CHUNK_BYTES):
+        chain = engine.cbc_encrypt(schedule, chain, dat[i:min(i + UPDATE_CHUNK_BYTES, split)])[-BLOCK_SIZE_BYTES:]
+    last = (int.from_bytes(last, 'big') ^ int.from_bytes(subkey, 'big')).to_bytes(BLOCK_SIZE_BYTES, 'big')
+    return engine.cbc_encrypt(schedule, chain, last)
+
 def get_mac(plaintext, mac_key, mac_iv = None):
     """
     Return CBC-MAC block as bytes
     """
-    ciphertext = aes.aes_encrypt(plaintext, mac_key, mac_iv)
-    return ciphertext[:BLOCK_SIZE_BYTES], take_last_aes_block(ciphertext)
+    cbc_mac = CbcMac(mac_key, mac_iv)
+    cbc_mac.update(plaintext)
+    return cbc_mac.iv, cbc_mac.digest()
 
 def take_last_aes_block(ciphertext):
     cipher_length = len(ciphertext)
@@ -22,10 +144,59 @@ def check_mac(plaintext, mac_received, mac_key, mac_iv):
     """
     Confirm mac is good
     """
-    print (plaintext)
-    mac_val = get_mac(plaintext, mac_key, mac_iv)
-    if mac_val[1] != mac_received:
-        msg = "{} != {}".format(mac_val, mac_received)
-        print(msg)
-        return False
-    return True
+    return verify_macs([(plaintext, mac_received, mac_iv)], mac_key)[0]
+
+def set_debug_hook(hook):
+    """
+    Installs hook, a callable taking one message string, to receive diagnostics from
+    the verification functions. None (the default) turns diagnostics off.
+    """
+    global debug_hook
+    debug_hook = hook
+
+def verify_macs(items, mac_key):
+    """
+    Checks a batch of messages against their CBC-MAC tags. The key is expanded once
+    for the whole batch and every tag is compared in constant time. Nothing is
+    printed; mismatches are only reported to the hook set with set_debug_hook.
+
+    Arguments:
+    items -- Iterable of (message, tag, iv) tuples. Messages may be bytes-like, a list
+             of bytes or a string; tags and IVs bytes or lists of bytes.
+    mac_key -- 16 byte key shared by every message.
+
+    Returns a list of booleans, True where the tag is valid.
+    """
+    schedule = aes.get_key_schedule(mac_key)
+    results = []
+    for index, (dat, tag, mac_iv) in enumerate(items):
+        cbc_mac = CbcMac.from_schedule(schedule, mac_iv)
+        cbc_mac.update(dat)
+        valid = cbc_mac.verify(tag)
+        if not valid and debug_hook is not None:
+            debug_hook('MAC mismatch for message {} ({} bytes)'.format(index, len(dat)))
+        results.append(valid)
+    return results
+
+def self_test():
+    """
+    Runs the RFC 4493 known-answer tests against cmac.
+
+    Returns True if every answer matched.
+    """
+    key = bytes.fromhex(KNOWN_ANSWER_CMAC_KEY)
+    message = bytes.fromhex(KNOWN_ANSWER_CMAC_MESSAGE)
+    return all(cmac(key, message[:length]) == bytes.fromhex(tag) for length, tag in KNOWN_ANSWERS_CMAC)
+
+def results_bitmap(results):
+    """
+    Packs a list of verification results into an integer, bit i set if results[i] is True.
+    """
+    bitmap = 0
+    for index, valid in enumerate(results):
+        if valid:
+            bitmap |= 1 << index
+    return bitmap
+
+if __name__ == '__main__':
+    print('CMAC known answers: ' + ('ok' if self_test() else 'FAILED'))
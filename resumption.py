@@ -0,0 +1,264 @@
+"""
+Session resumption module
+
+After a full authenticated Diffie-Hellman handshake the server issues the client an
+encrypted ticket, which only the server can read. A returning client sends the ticket
+with a fresh nonce and an HMAC under the resumption secret over both, proving it holds
+the secret and not just a ticket sniffed off the wire. The server opens the ticket,
+checks the proof, only then redeems the ticket in its ticket cache, and replies with
+its own nonce. Both sides then derive a new session secret from the
+resumption secret, the long-term key and the two nonces with HKDF. That is one round trip and
+no modular exponentiation.
+
+Tickets are single use: every resumption hands the client a new one. The server cache
+bounds how many are live, drops expired ones, and evicts the least recently issued
+when it is full.
+
+Classes:
+
+TicketCache -- Server side record of live tickets with expiry and LRU eviction.
+TicketIssuer -- Server side ticket encryption, validation and key derivation.
+ClientTickets -- Client side store of the ticket for each server.
+
+Functions:
+
+is_resume_request -- Tells a resumption request apart from a full handshake message.
+is_ticket_message -- Tells a new ticket message apart from other data.
+"""
+
+import collections
+import hashlib
+import hmac
+import secrets
+import struct
+import threading
+import time
+
+import aead
+import kdf
+
+NONCE_SIZE = 16
+TICKET_ID_SIZE = 16
+SECRET_SIZE = 16
+PROOF_SIZE = 16
+
+# Seconds a ticket stays valid, and the number of live tickets the server keeps
+TICKET_LIFETIME = 3600
+TICKET_CACHE_SIZE = 1024
+
+# Message prefixes. The first full handshake message is a bare 20 byte ID and nonce,
+# so a request starting with RESUME_MAGIC and longer than that cannot be mistaken for one.
+RESUME_MAGIC = b'RSM1'
+ACCEPT_MAGIC = b'RSOK'
+REJECT_MAGIC = b'RSNO'
+TICKET_MAGIC = b'TKT1'
+NO_TICKET_MAGIC = b'TKT0'
+
+# ticket id, resumption secret, expiry (seconds since the epoch)
+ticket_struct = struct.Struct('>{}s{}sQ'.format(TICKET_ID_SIZE, SECRET_SIZE))
+# ticket lifetime in seconds, prefixed to the ticket in a ticket message
+lifetime_struct = struct.Struct('>I')
+
+TICKET_SIZE = aead.NONCE_SIZE + ticket_struct.size + aead.TAG_SIZE
+
+def resumption_secret(session_key, long_term_key):
+    """
+    Returns the secret a ticket carries for the session established with the session
+    secret session_key.
+    """
+    return kdf.hkdf(session_key, long_term_key, b'vpn resumption', SECRET_SIZE)
+
+def resumed_session_key(secret, long_term_key, client_nonce, server_nonce):
+    """
+    Returns the session secret of a resumed session, to derive its keys from like a
+    Diffie-Hellman shared secret.
+    """
+    return kdf.hkdf(secret, long_term_key, b'vpn resumed' + bytes(client_nonce) + bytes(server_nonce),
+                    kdf.HASH_SIZE)
+
+def _client_proof(secret, client_nonce, ticket):
+    """Returns the tag proving the client holds the resumption secret of ticket."""
+    message = b'vpn client proof' + bytes(client_nonce) + bytes(ticket)
+    return hmac.new(secret, message, hashlib.sha256).digest()[:PROOF_SIZE]
+
+def _server_proof(session_key, client_nonce, server_nonce):
+    """Returns the tag proving the server derived the same resumed session secret."""
+    message = b'vpn server proof' + bytes(client_nonce) + bytes(server_nonce)
+    return hmac.new(session_key, message, hashlib.sha256).digest()[:PROOF_SIZE]
+
+def is_resume_request(message):
+    return bytes(message[:len(RESUME_MAGIC)]) == RESUME_MAGIC and len(message) > 20
+
+def is_ticket_message(message):
+    return bytes(message[:len(TICKET_MAGIC)]) in (TICKET_MAGIC, NO_TICKET_MAGIC)
+
+class TicketCache(object):
+    """
+    Live tickets on the server, by ticket id. Redeeming a ticket removes it, so a
+    replayed resumption request is refused.
+    """
+    def __init__(self, max_entries=TICKET_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, ticket_id, expiry):
+        with self.lock:
+            self.entries[ticket_id] = expiry
+            self.entries.move_to_end(ticket_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def redeem(self, ticket_id, now=None):
+        """
+        Returns whether ticket_id was live and unexpired, removing it either way.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            expiry = self.entries.pop(ticket_id, None)
+        return expiry is not None and now < expiry
+
+    def purge(self, now=None):
+        """Drops every expired ticket."""
+        now = time.time() if now is None else now
+        with self.lock:
+            for ticket_id in [t for t, expiry in self.entries.items() if expiry <= now]:
+                del self.entries[ticket_id]
+
+    def __len__(self):
+        return len(self.entries)
+
+class TicketIssuer(object):
+    """
+    Server side of session resumption. Tickets are sealed with encrypt-then-MAC under
+    keys that never leave this object, so a client cannot read or forge them.
+    """
+    def __init__(self, cache=None, lifetime=TICKET_LIFETIME):
+        self.cache = TicketCache() if cache is None else cache
+        self.lifetime = lifetime
+        # Long-lived secrets, drawn from the OS CSPRNG rather than the nonce helper
+        self.enc_key = secrets.token_bytes(16)
+        self.mac_key = secrets.token_bytes(16)
+
+    def issue(self, session_key, long_term_key):
+        """
+        Returns the ticket message to send to the client after a session is established
+        with session_key, or a no-ticket message if session_key is invalid.
+        """
+        if not session_key:
+            return NO_TICKET_MAGIC
+        ticket_id = secrets.token_bytes(TICKET_ID_SIZE)
+        expiry = int(time.time()) + self.lifetime
+        self.cache.purge()
+        self.cache.add(ticket_id, expiry)
+        nonce = aead.gen_nonce()
+        contents = ticket_struct.pack(ticket_id, resumption_secret(session_key, long_term_key), expiry)
+        ticket = nonce + aead.etm_seal(self.enc_key, self.mac_key, nonce, contents)
+        return TICKET_MAGIC + lifetime_struct.pack(self.lifetime) + ticket
+
+    def _open_ticket(self, ticket):
+        """
+        Returns tuple(ticket_id, secret, expiry) from ticket, or None if this issuer did
+        not seal it. The ticket is not redeemed.
+        """
+        if len(ticket) != TICKET_SIZE:
+            return None
+        contents = aead.etm_open(self.enc_key, self.mac_key, ticket[:aead.NONCE_SIZE], ticket[aead.NONCE_SIZE:])
+        if contents is None:
+            return None
+        return ticket_struct.unpack(contents)
+
+    def resume(self, request, long_term_key):
+        """
+        Handles a resumption request from a client.
+
+        Returns: tuple(session_key, response). session_key is None if the ticket was
+        refused, in which case the response tells the client to fall back to a full
+        handshake.
+        """
+        request = bytes(request)
+        if len(request) != len(RESUME_MAGIC) + NONCE_SIZE + TICKET_SIZE + PROOF_SIZE:
+            return None, REJECT_MAGIC
+        start = len(RESUME_MAGIC)
+        client_nonce = request[start:start + NONCE_SIZE]
+        ticket = request[start + NONCE_SIZE:start + NONCE_SIZE + TICKET_SIZE]
+        proof = request[start + NONCE_SIZE + TICKET_SIZE:]
+        contents = self._open_ticket(ticket)
+        if contents is None:
+            return None, REJECT_MAGIC
+        ticket_id, secret, expiry = contents
+        # Check the proof before redeeming, so a sniffed ticket cannot burn the client's
+        if not hmac.compare_digest(_client_proof(secret, client_nonce, ticket), proof):
+            return None, REJECT_MAGIC
+        if time.time() >= expiry or not self.cache.redeem(ticket_id):
+            return None, REJECT_MAGIC
+        server_nonce = aead.gen_nonce(NONCE_SIZE)
+        session_key = resumed_session_key(secret, long_term_key, client_nonce, server_nonce)
+        response = (ACCEPT_MAGIC + server_nonce + _server_proof(session_key, client_nonce, server_nonce)
+                    + self.issue(session_key, long_term_key))
+        return session_key, response
+
+class ClientTickets(object):
+    """
+    Client side of session resumption: the latest ticket and resumption secret for each
+    server, keyed by whatever identifies the peer (e.g. a (host, port) tuple).
+    """
+    def __init__(self):
+        self.tickets = {}
+        self.lock = threading.Lock()
+
+    def store(self, peer, message, session_key, long_term_key):
+        """
+        Stores the ticket in a ticket message from the server for session_key.
+
+        Returns whether the message held a ticket.
+        """
+        message = bytes(message)
+        header = len(TICKET_MAGIC) + lifetime_struct.size
+        if message[:len(TICKET_MAGIC)] != TICKET_MAGIC or len(message) != header + TICKET_SIZE:
+            return False
+        lifetime, = lifetime_struct.unpack_from(message, len(TICKET_MAGIC))
+        entry = (message[header:], resumption_secret(session_key, long_term_key), time.time() + lifetime)
+        with self.lock:
+            self.tickets[peer] = entry
+        return True
+
+    def resume_request(self, peer):
+        """
+        Takes the ticket for peer, since tickets are single use.
+
+        Returns: tuple(request, state) to send the request and later pass state to
+        complete, or None if there is no unexpired ticket for peer.
+        """
+        with self.lock:
+            entry = self.tickets.pop(peer, None)
+        if entry is None or time.time() >= entry[2]:
+            return None
+        ticket, secret, _ = entry
+        client_nonce = aead.gen_nonce(NONCE_SIZE)
+        request = RESUME_MAGIC + client_nonce + ticket + _client_proof(secret, client_nonce, ticket)
+        return request, (peer, secret, client_nonce)
+
+    def complete(self, state, response, long_term_key):
+        """
+        Finishes a resumption with the server response, storing the new ticket it carries.
+
+        Returns the resumed session key, None if the server refused the ticket (fall back
+        to a full handshake) or 0 if the server failed to prove it holds the same key.
+        """
+        peer, secret, client_nonce = state
+        response = bytes(response)
+        if response[:len(ACCEPT_MAGIC)] != ACCEPT_MAGIC:
+            return None
+        start = len(ACCEPT_MAGIC)
+        server_nonce = response[start:start + NONCE_SIZE]
+        proof = response[start + NONCE_SIZE:start + NONCE_SIZE + PROOF_SIZE]
+        session_key = resumed_session_key(secret, long_term_key, client_nonce, server_nonce)
+        if not hmac.compare_digest(_server_proof(session_key, client_nonce, server_nonce), proof):
+            return 0
+        self.store(peer, response[start + NONCE_SIZE + PROOF_SIZE:], session_key, long_term_key)
+        return session_key
+
+    def forget(self, peer):
+        with self.lock:
+            self.tickets.pop(peer, None)